@@ -0,0 +1,105 @@
+from LibPeerFrom.Helpers import RESERVED_NETWORKS
+from LibPeerFrom.RangeIndex import RangeIndex
+from ipaddress import ip_address, ip_network
+from typing import Union
+
+import shlex
+
+
+class CaptureProfile:
+    # Describes what the router should capture for us: a bpf filter generated from the game's
+    # traffic (udp only, optionally limited to some ports, without reserved addresses, known
+    # servers or common non-game services), how much of each packet to keep (snaplen), and how
+    # much of each payload to use for resend detection.
+    PROFILES = {
+        # everything to and from the host, as tcpdump "host x" would give us
+        "full": {"udp_only": False, "exclude_ports": [], "exclude_reserved": False, "exclude_servers": False,
+                 "snaplen": 0, "resend_prefix_bytes": 0},
+        # only traffic that could be from a peer, full packets
+        "udp": {"snaplen": 0, "resend_prefix_bytes": 0},
+        # only traffic that could be from a peer, and only the start of each packet.
+        # 64 bytes leaves room for ethernet, vlan, ip and udp headers
+        "lean": {"snaplen": 64 + 96, "resend_prefix_bytes": 96},
+    }
+    DEFAULT_PROFILE = "udp"
+    # udp services that are never a peer: dns, dhcp, ntp, ssdp, mdns, quic
+    DEFAULT_EXCLUDE_PORTS = [53, 67, 68, 123, 443, 1900, 5353]
+    # bpf programs have a size limit, so large range files (e.g. all of AWS) are left to Peers
+    max_filter_networks = 64
+
+    name: str
+    udp_only: bool
+    ports: list[tuple[int, int]]
+    exclude_ports: list[int]
+    exclude_reserved: bool
+    exclude_servers: bool
+    snaplen: int                # 0 for whole packets
+    resend_prefix_bytes: int    # 0 for whole payloads
+
+    def __init__(self, name: str = DEFAULT_PROFILE, **overrides):
+        if name not in self.PROFILES: raise ValueError("Invalid capture profile specified")
+        self.name = name
+        self.udp_only = True
+        self.ports = []
+        self.exclude_ports = list(self.DEFAULT_EXCLUDE_PORTS)
+        self.exclude_reserved = True
+        self.exclude_servers = True
+        self.snaplen = 0
+        self.resend_prefix_bytes = 0
+        for setting in [self.PROFILES[name], overrides]:
+            for key, value in setting.items():
+                if not hasattr(self, key): raise ValueError(f"Invalid capture setting {key}")
+                if value is not None: setattr(self, key, value)
+
+    @staticmethod
+    def parse_ports(ports: str) -> list[tuple[int, int]]:
+        # "3000-3100,5000" -> [(3000, 3100), (5000, 5000)]
+        ranges = []
+        for part in ports.split(","):
+            part = part.strip()
+            if part == "": continue
+            low, _, high = part.partition("-")
+            ranges.append((int(low), int(high or low)))
+        return ranges
+
+    def _exclude_network(self, local: ip_address, network: str) -> Union[None, str]:
+        net = ip_network(network, strict=False)
+        if net.version != 4: return None
+        if local not in net:
+            # the local side can't match, so this only ever matches the remote side
+            return f"net {net}"
+        # the local side is always in this network, so only drop packets where the remote side is too
+        return f"(src net {net} and dst net {net})"
+
+    def bpf_filter(self, local_ip: str, server_ranges: RangeIndex = None) -> str:
+        local = ip_address(local_ip)
+        clauses = [f"host {local}"]
+        if not self.udp_only:
+            return clauses[0]
+        clauses.insert(0, "ip and udp")
+        if len(self.ports) > 0:
+            clauses.append("(" + " or ".join(f"udp port {low}" if low == high else f"udp portrange {low}-{high}"
+                                             for low, high in self.ports) + ")")
+        if len(self.exclude_ports) > 0:
+            clauses.append("not (" + " or ".join(f"udp port {port}" for port in self.exclude_ports) + ")")
+        networks = []
+        if self.exclude_reserved:
+            networks += RESERVED_NETWORKS
+        if self.exclude_servers and server_ranges is not None:
+            servers = server_ranges.networks(4)
+            if len(servers) <= self.max_filter_networks:
+                networks += servers
+        excluded = [n for n in (self._exclude_network(local, n) for n in networks) if n is not None]
+        if len(excluded) > 0:
+            clauses.append("not (" + " or ".join(excluded) + ")")
+        return " and ".join(clauses)
+
+    def tcpdump_command(self, local_ip: str, server_ranges: RangeIndex = None,
+                        tcpdump_path: str = "/usr/sbin/tcpdump") -> str:
+        command = f"{tcpdump_path} -U -w -"
+        if self.snaplen > 0:
+            command += f" -s {self.snaplen}"
+        return command + " " + shlex.quote(self.bpf_filter(local_ip, server_ranges))
+
+    def __str__(self):
+        return f"{self.name} (snaplen {self.snaplen or 'full'}, resend prefix {self.resend_prefix_bytes or 'full'})"
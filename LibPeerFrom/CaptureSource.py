@@ -0,0 +1,200 @@
+from LibPeerFrom.PcapReader import PCAP_MAGIC
+from typing import BinaryIO
+
+import array
+import atexit
+import fcntl
+import os
+import select
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+import threading
+import time
+
+
+def bytes_waiting(stream) -> int:
+    # how many bytes can be read from a pipe without blocking, without reading them
+    count = array.array('i', [0])
+    fcntl.ioctl(stream.fileno(), termios.FIONREAD, count)
+    return count[0]
+
+
+def wait_for_stream(process: subprocess.Popen, timeout: float = 10) -> bool:
+    # tcpdump -U flushes the pcap header as soon as the capture starts, so the first readable byte
+    # tells us ssh has connected and tcpdump is running, without reading (and losing) anything.
+    # returns False if the process exits without writing anything. a short command (e.g. replaying
+    # a small file) can write everything and exit before we look, which still counts as started.
+    # after timeout we give up waiting and carry on if it's still running, e.g. a slow ssh login.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        readable, _, _ = select.select([process.stdout], [], [], 0.05)
+        if len(readable) > 0:
+            # a pipe is also readable once it's closed, with nothing in it
+            return bytes_waiting(process.stdout) > 0
+        if process.poll() is not None:
+            return False
+    return process.poll() is None
+
+
+def ssh_command(router_address: str, remote_command: str, control_path: str = None) -> list[str]:
+    # reconnects share one persistent ssh connection (ControlMaster), so they don't pay for a new login.
+    # ServerAlive makes ssh notice a dead link (e.g. a router reboot) in seconds rather than hanging
+    if control_path is None:
+        control_path = os.path.join(tempfile.gettempdir(), "wdtpcf-%C")
+    return ["ssh",
+            "-o", "ControlMaster=auto", "-o", f"ControlPath={control_path}", "-o", "ControlPersist=10m",
+            "-o", "ServerAliveInterval=5", "-o", "ServerAliveCountMax=3",
+            router_address, remote_command]
+
+
+class ReconnectingCapture:
+    # Runs a capture command (normally ssh to the router, running tcpdump -w -) and restarts it with
+    # backoff whenever it exits. Every run's pcap stream is spliced into one continuous stream on
+    # self.stream: the first run's file header is passed on, later runs' headers are dropped, and
+    # only whole packet records are forwarded, so a run that dies half way through a packet doesn't
+    # corrupt what follows. Whatever reads self.stream (PipeCapture, PcapReader) never sees the gap,
+    # so peers and their timestamps carry on as if the capture had just been quiet.
+    initial_backoff = 0.5
+    max_backoff = 30
+    # a run that lasted this long resets the backoff
+    backoff_reset_seconds = 30
+    ready_timeout = 10
+    # no sane packet record is bigger than this, so anything bigger means the stream is corrupt
+    max_record_size = 262144
+
+    command: list[str]
+    stream: BinaryIO
+    process: subprocess.Popen
+    reconnects: int
+    _write_fd: int
+    _header: bytes
+    _stopping: threading.Event
+    _thread: threading.Thread
+
+    def __init__(self, command: list[str]):
+        self.command = command
+        read_fd, self._write_fd = os.pipe()
+        self.stream = os.fdopen(read_fd, 'rb', buffering=0)
+        self.process = None
+        self.reconnects = 0
+        self._header = None
+        self._stopping = threading.Event()
+        self._thread = None
+        atexit.register(self.close)
+        # forked processes (e.g. --workers) inherit the write end, and as long as any of them holds
+        # it open the reader never sees the stream end once we give up
+        os.register_at_fork(after_in_child=self._close_writer_in_child)
+
+    def _spawn(self) -> bool:
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, bufsize=0)
+        return wait_for_stream(self.process, self.ready_timeout)
+
+    # returns False if the first run fails, as there's probably something wrong with the command
+    def start(self) -> bool:
+        if not self._spawn():
+            return False
+        self._thread = threading.Thread(target=self._run, name="ReconnectingCapture", daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self) -> None:
+        backoff = self.initial_backoff
+        try:
+            while not self._stopping.is_set():
+                started = time.monotonic()
+                if not self._relay(self.process):
+                    return
+                if self._stopping.is_set():
+                    return
+                if time.monotonic() - started >= self.backoff_reset_seconds:
+                    backoff = self.initial_backoff
+                print(f"capture exited ({self.process.poll()}), reconnecting in {backoff}s")
+                sys.stdout.flush()
+                if self._stopping.wait(backoff):
+                    return
+                backoff = min(backoff * 2, self.max_backoff)
+                self.reconnects += 1
+                self._spawn()
+        finally:
+            if self.process.poll() is None:
+                self.process.kill()
+            self._close_writer()
+
+    def _read(self, fd: int, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = os.read(fd, size - len(data))
+            if not chunk: return None
+            data += chunk
+        return data
+
+    def _write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(self._write_fd, view):]
+
+    # relays one run of the command until it ends. returns False if its stream can't be spliced in
+    def _relay(self, process: subprocess.Popen) -> bool:
+        fd = process.stdout.fileno()
+        try:
+            header = self._read(fd, 24)
+            if header is None:
+                return True
+            if header[:4] not in PCAP_MAGIC:
+                print("error: capture is not a classic pcap stream (tcpdump -w -)")
+                return False
+            if self._header is None:
+                self._header = header
+                self._write(header)
+            elif header != self._header:
+                print("error: capture format changed after reconnecting")
+                return False
+            incl_len = struct.Struct(PCAP_MAGIC[header[:4]][0] + "I")
+
+            buffer = bytearray()
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk: return True
+                buffer += chunk
+                # forward every complete record, keep the partial one (if any) for the next read
+                offset = 0
+                while len(buffer) - offset >= 16:
+                    size = incl_len.unpack_from(buffer, offset + 8)[0]
+                    if size > self.max_record_size:
+                        print("capture stream is corrupt, reconnecting")
+                        process.kill()
+                        return True
+                    if len(buffer) - offset - 16 < size: break
+                    offset += 16 + size
+                if offset > 0:
+                    self._write(bytes(buffer[:offset]))
+                    del buffer[:offset]
+        except OSError:
+            # the reader has gone away
+            return False
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+
+    def _close_writer(self) -> None:
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def _close_writer_in_child(self) -> None:
+        # the relay thread doesn't survive the fork, so nothing in the child will ever write
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def close(self) -> None:
+        self._stopping.set()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+        if self._thread is None:
+            self._close_writer()
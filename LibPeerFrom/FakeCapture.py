@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# A stand in for "ssh router tcpdump -U -w -", for testing the reconnect path without a router:
+# replays a pcap file to stdout in real time (with timestamps moved to now), and dies after a
+# random lifetime, part way through a packet, the way a dropped ssh session would.
+#
+#   ./WhereDoThePeersComeFrom.py --address=10.0.0.50 \
+#       --capture_command="python3 -m LibPeerFrom.FakeCapture --max_lifetime=20 capture.pcap"
+import sys
+import time
+import random
+import getopt
+import struct
+
+from LibPeerFrom.PcapReader import PCAP_MAGIC
+
+
+def usage():
+    print("FakeCapture.py: replay a pcap file to stdout like tcpdump -U -w -, exiting at random")
+    print("usage: python3 -m LibPeerFrom.FakeCapture [options] file.pcap")
+    print("options:")
+    print(" --min_lifetime:     shortest time to run for, in seconds. default is 2")
+    print(" --max_lifetime:     longest time to run for, in seconds. default is 10. 0 runs until the file ends")
+    print(" --connect_delay:    seconds to wait before writing anything, like an ssh login. default is 0")
+    print(" --exit_code:        exit code when the lifetime is up. default is 255, as ssh uses")
+    print(" --seed:             random seed, for repeatable runs")
+    print(" --loop:             start the file again when it ends")
+
+
+def read_records(path: str) -> tuple[bytes, list[tuple[float, bytes]]]:
+    # the pcap file header, and (timestamp, record without its header) for every packet
+    with open(path, 'rb') as pcap:
+        header = pcap.read(24)
+        if header[:4] not in PCAP_MAGIC: raise ValueError("Expected a classic pcap file")
+        endian, units = PCAP_MAGIC[header[:4]]
+        record_header = struct.Struct(endian + "IIII")
+        records = []
+        while True:
+            data = pcap.read(16)
+            if len(data) < 16: break
+            ts_sec, ts_frac, incl_len, orig_len = record_header.unpack(data)
+            frame = pcap.read(incl_len)
+            if len(frame) < incl_len: break
+            records.append((ts_sec + ts_frac / units, struct.pack(endian + "II", incl_len, orig_len) + frame))
+    return header, records
+
+
+def replay(path: str, lifetime: float, connect_delay: float, loop: bool, out=None) -> bool:
+    # returns True if the lifetime ran out, False if the file did
+    if out is None: out = sys.stdout.buffer
+    header, records = read_records(path)
+    endian, units = PCAP_MAGIC[header[:4]]
+    timestamp = struct.Struct(endian + "II")
+    time.sleep(connect_delay)
+    out.write(header)
+    out.flush()
+
+    started = time.time()
+    offset = started - records[0][0] if len(records) > 0 else 0
+    while True:
+        for ts, record in records:
+            ts += offset
+            if lifetime > 0 and ts - started >= lifetime:
+                time.sleep(max(started + lifetime - time.time(), 0))
+                # die part way through the next packet
+                partial = timestamp.pack(int(ts), 0) + record
+                out.write(partial[:random.randrange(len(partial))])
+                out.flush()
+                return True
+            time.sleep(max(ts - time.time(), 0))
+            out.write(timestamp.pack(int(ts), int((ts % 1) * units)) + record)
+            out.flush()
+        if not loop or len(records) == 0:
+            return False
+        # carry on from where the file ended
+        offset += records[-1][0] - records[0][0] + 1
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "min_lifetime=", "max_lifetime=", "connect_delay=",
+                                                       "exit_code=", "seed=", "loop"])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        exit(2)
+    min_lifetime = 2
+    max_lifetime = 10
+    connect_delay = 0
+    exit_code = 255
+    loop = False
+    for o, a in opts:
+        if o in ["--help", "-h"]:
+            usage()
+            exit()
+        elif o in ["--min_lifetime"]:
+            min_lifetime = float(a)
+        elif o in ["--max_lifetime"]:
+            max_lifetime = float(a)
+        elif o in ["--connect_delay"]:
+            connect_delay = float(a)
+        elif o in ["--exit_code"]:
+            exit_code = int(a)
+        elif o in ["--seed"]:
+            random.seed(a)
+        elif o in ["--loop"]:
+            loop = True
+    if len(args) != 1:
+        usage()
+        exit(2)
+
+    lifetime = random.uniform(min_lifetime, max(min_lifetime, max_lifetime)) if max_lifetime > 0 else 0
+    try:
+        if replay(args[0], lifetime, connect_delay, loop):
+            exit(exit_code)
+    except BrokenPipeError:
+        exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
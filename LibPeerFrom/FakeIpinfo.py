@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# A local stand in for ipinfo.io, for testing and benchmarking geoip lookups without the internet
+# (or a token). Every address gets a made up but stable location, and responses can be slowed
+# down, fail, or be rate limited like the real thing.
+#
+#   python3 -m LibPeerFrom.FakeIpinfo --port=8765 --latency_ms=80 --rate_limit=0.05 &
+#   ./WhereDoThePeersComeFrom.py --address=10.0.0.50 --ipinfo_url=http://127.0.0.1:8765
+import sys
+import json
+import time
+import zlib
+import random
+import getopt
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# (country, region, city, latitude, longitude). addresses in the same /24 share a place, and
+# places in the same region are close together, so city, nearby and region estimates all get used
+PLACES = [
+    ("AU", "Victoria", "Melbourne", -37.8136, 144.9631),
+    ("AU", "Victoria", "Geelong", -38.1499, 144.3617),
+    ("AU", "New South Wales", "Sydney", -33.8688, 151.2093),
+    ("AU", "Queensland", "Brisbane", -27.4698, 153.0251),
+    ("AU", "Western Australia", "Perth", -31.9505, 115.8605),
+    ("NZ", "Auckland", "Auckland", -36.8485, 174.7633),
+    ("JP", "Tokyo", "Tokyo", 35.6762, 139.6503),
+    ("SG", "Singapore", "Singapore", 1.3521, 103.8198),
+    ("US", "California", "Los Angeles", 34.0522, -118.2437),
+    ("US", "California", "San Jose", 37.3382, -121.8863),
+    ("US", "Texas", "Dallas", 32.7767, -96.7970),
+    ("US", "New York", "New York City", 40.7128, -74.0060),
+    ("BR", "Sao Paulo", "Sao Paulo", -23.5505, -46.6333),
+    ("GB", "England", "London", 51.5074, -0.1278),
+    ("DE", "Hesse", "Frankfurt am Main", 50.1109, 8.6821),
+]
+
+
+def fake_location(ip_addr: str) -> dict:
+    subnet = ip_addr.rsplit(".", 1)[0]
+    country, region, city, latitude, longitude = PLACES[zlib.crc32(subnet.encode()) % len(PLACES)]
+    return {"ip": ip_addr, "city": city, "region": region, "country": country,
+            "loc": f"{latitude:.4f},{longitude:.4f}",
+            "org": f"AS{zlib.crc32(subnet.encode()) % 60000} Example Broadband", "timezone": "Etc/UTC"}
+
+
+class FakeIpinfo:
+    # a threaded http server answering /<ip>/json like ipinfo.io.
+    # latency_ms (plus up to jitter_ms) is added to every response, error_rate of them are 500s,
+    # and rate_limit of them are 429s, as ipinfo gives when you're over your quota
+    latency_ms: float
+    jitter_ms: float
+    error_rate: float
+    rate_limit: float
+    amazon_rate: float      # the share of addresses that look like AWS relay servers
+    requests: int
+    errors: int
+    rate_limited: int
+    max_concurrent: int
+    _active: int
+    _lock: threading.Lock
+    _server: ThreadingHTTPServer
+    _thread: threading.Thread
+
+    def __init__(self, port: int = 0, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0,
+                 rate_limit: float = 0, amazon_rate: float = 0, host: str = "127.0.0.1"):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.amazon_rate = amazon_rate
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.max_concurrent = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handle(self, request: BaseHTTPRequestHandler) -> None:
+        with self._lock:
+            self.requests += 1
+            self._active += 1
+            self.max_concurrent = max(self.max_concurrent, self._active)
+        try:
+            time.sleep((self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000)
+            parts = request.path.split("?")[0].strip("/").split("/")
+            roll = random.random()
+            if roll < self.rate_limit:
+                with self._lock: self.rate_limited += 1
+                status, body = 429, {"status": 429, "error": {"title": "Rate limit exceeded",
+                                                              "message": "Upgrade to increase your usage limits"}}
+            elif roll < self.rate_limit + self.error_rate:
+                with self._lock: self.errors += 1
+                status, body = 500, {"status": 500, "error": {"title": "Internal error"}}
+            else:
+                status, body = 200, fake_location(parts[0])
+                if zlib.crc32(parts[0].encode()) % 10000 < self.amazon_rate * 10000:
+                    body["org"] = "AS16509 Amazon.com, Inc."
+            data = json.dumps(body).encode()
+            request.send_response(status)
+            request.send_header("Content-Type", "application/json")
+            request.send_header("Content-Length", str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def start(self) -> "FakeIpinfo":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeIpinfo", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+
+def usage():
+    print("FakeIpinfo.py: a local stand in for ipinfo.io")
+    print("usage: python3 -m LibPeerFrom.FakeIpinfo [options]")
+    print("options:")
+    print(" --port:             port to listen on. default is 8765")
+    print(" --latency_ms:       added to every response. default is 0")
+    print(" --jitter_ms:        up to this much more is added at random. default is 0")
+    print(" --error_rate:       share of requests that fail with a 500. default is 0")
+    print(" --rate_limit:       share of requests that are rate limited with a 429. default is 0")
+    print(" --amazon_rate:      share of addresses that look like AWS servers. default is 0")
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "port=", "latency_ms=", "jitter_ms=", "error_rate=",
+                                                       "rate_limit=", "amazon_rate="])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        exit(2)
+    settings = {"port": 8765}
+    for o, a in opts:
+        if o in ["--help", "-h"]:
+            usage()
+            exit()
+        elif o in ["--port"]:
+            settings["port"] = int(a)
+        else:
+            settings[o.lstrip("-")] = float(a)
+    server = FakeIpinfo(**settings)
+    print("fake ipinfo listening on", server.url)
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
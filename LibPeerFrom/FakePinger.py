@@ -0,0 +1,89 @@
+from ipaddress import ip_address, ip_network
+from typing import Union
+
+import json
+import random
+import time
+import zlib
+
+
+class PingProfile:
+    latency_ms: float
+    jitter_ms: float
+    loss: float     # 0-1, the share of pings that go unanswered
+
+    def __init__(self, latency_ms: float = 50, jitter_ms: float = 0, loss: float = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+
+    def __repr__(self):
+        return f"<PingProfile {self.latency_ms}ms +{self.jitter_ms}ms, {self.loss:.0%} loss>"
+
+
+class FakePinger:
+    # A stand in for ping3.ping, for testing and benchmarking without sending any icmp.
+    # Each address gets a latency and loss profile: an exact ip, the most specific matching
+    # network, or the default. Pings take as long as the real thing would (the latency, or the
+    # timeout if lost), so maintenance takes as long as it would against real peers.
+    # Profiles can come from a json file like:
+    #   {"default": {"latency_ms": 80, "jitter_ms": 10, "loss": 0.1},
+    #    "101.0.0.0/8": {"latency_ms": 250, "loss": 0.5},
+    #    "1.2.3.4": {"loss": 1}}
+    # "spread_ms" in the default gives each address its own stable latency, up to this much more.
+    default: PingProfile
+    spread_ms: float
+    sleep: bool
+    pings: int
+    lost: int
+    _addresses: dict[str, PingProfile]
+    _networks: list[tuple["ip_network", PingProfile]]
+
+    def __init__(self, profiles: dict[str, PingProfile] = None, default: PingProfile = None,
+                 spread_ms: float = 0, sleep: bool = True):
+        self.default = default or PingProfile()
+        self.spread_ms = spread_ms
+        self.sleep = sleep
+        self.pings = 0
+        self.lost = 0
+        self._addresses = dict()
+        self._networks = []
+        for key, profile in (profiles or dict()).items():
+            if "/" in key:
+                self._networks.append((ip_network(key, strict=False), profile))
+            else:
+                self._addresses[key] = profile
+        # most specific first
+        self._networks.sort(key=lambda n: n[0].prefixlen, reverse=True)
+
+    @staticmethod
+    def from_file(fileName: str, sleep: bool = True) -> "FakePinger":
+        with open(fileName, 'r') as profile_file:
+            data = json.load(profile_file)
+        default = data.pop("default", dict())
+        spread_ms = default.pop("spread_ms", 0)
+        return FakePinger({k: PingProfile(**v) for k, v in data.items()}, PingProfile(**default), spread_ms, sleep)
+
+    def profile_for(self, address: str) -> tuple[PingProfile, float]:
+        # the profile, and the latency (ms) for this address
+        if address in self._addresses:
+            profile = self._addresses[address]
+            return profile, profile.latency_ms
+        ip = ip_address(address)
+        for network, profile in self._networks:
+            if ip in network:
+                return profile, profile.latency_ms
+        spread = self.spread_ms * (zlib.crc32(address.encode()) % 1000) / 1000
+        return self.default, self.default.latency_ms + spread
+
+    def __call__(self, address: str, unit: str = "s", timeout: float = 4, **kwargs) -> Union[None, float]:
+        # same as ping3.ping: the delay in unit ("s" or "ms"), or None if there was no reply in time
+        profile, latency_ms = self.profile_for(address)
+        latency_ms += random.uniform(0, profile.jitter_ms)
+        self.pings += 1
+        if random.random() < profile.loss or latency_ms / 1000 > timeout:
+            self.lost += 1
+            if self.sleep: time.sleep(timeout)
+            return None
+        if self.sleep: time.sleep(latency_ms / 1000)
+        return latency_ms if unit == "ms" else latency_ms / 1000
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+
+
+class FriendlyNames:
+    # An in memory copy of the json map from ip to friendly name.
+    # The file is only read again when its mtime changes, and newly seen ips are added to it in
+    # batches, so the user can keep editing it while we're running. Writes re-read the file first
+    # and go through a temporary file, so we never write over (or half write) their changes.
+    # Unnamed entries are only kept for current peers, so the file doesn't fill up with everyone
+    # we've ever met.
+    _fileName: str
+    _names: dict[str, str]
+    _known: set[str]
+    _unnamed: set[str]
+    _pending: set[str]
+    _mtime: float
+
+    def __init__(self, fileName: str):
+        self._fileName = fileName
+        self._names = dict()
+        self._known = set()
+        self._unnamed = set()
+        self._pending = set()
+        self._mtime = None
+        self.reload_if_changed()
+
+    def _stat(self) -> float:
+        try:
+            return os.stat(self._fileName).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _read(self) -> dict[str, str]:
+        # returns None if the file can't be parsed (e.g. it's half way through being edited)
+        try:
+            with open(self._fileName, 'r') as friendlyname_file:
+                return json.load(friendlyname_file)
+        except FileNotFoundError:
+            return dict()
+        except json.JSONDecodeError:
+            print("Couldn't parse friendly name file", self._fileName)
+            return None
+
+    # returns True if the names have changed
+    def reload_if_changed(self) -> bool:
+        mtime = self._stat()
+        if mtime == self._mtime: return False
+        data = self._read()
+        if data is None: return False
+        self._mtime = mtime
+        names = {k: v for k, v in data.items() if v != ""}
+        self._known = set(data.keys())
+        self._unnamed = self._known - names.keys()
+        changed = names != self._names
+        self._names = names
+        return changed
+
+    def name_for(self, ip: str) -> str:
+        return self._names.get(ip, "")
+
+    def add_ip(self, ip: str) -> None:
+        # queue an ip we've seen, so the user can name it
+        if ip not in self._known:
+            self._pending.add(ip)
+
+    # writes the queued ips to the file, and drops the unnamed entries for ips not in present
+    def flush(self, present: set[str]) -> None:
+        if len(self._pending) == 0 and len(self._unnamed - present) == 0: return
+        self.reload_if_changed()
+        data = self._read()
+        if data is None: return
+        data = {k: v for k, v in data.items() if v != "" or k in present}
+        for ip in self._pending & present:
+            if ip not in data:
+                data[ip] = ""
+        directory = os.path.dirname(os.path.abspath(self._fileName))
+        fd, temp_path = tempfile.mkstemp(prefix=".friendlynames", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as temp_file:
+                json.dump(data, temp_file, sort_keys=True, indent=4)
+            if os.path.exists(self._fileName):
+                os.chmod(temp_path, os.stat(self._fileName).st_mode & 0o7777)
+            os.replace(temp_path, self._fileName)
+        except:
+            os.remove(temp_path)
+            raise
+        self._known = set(data.keys())
+        self._unnamed = {k for k, v in data.items() if v == ""}
+        self._pending = set()
+        self._mtime = self._stat()
+
+    def __contains__(self, ip: str) -> bool:
+        return ip in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
@@ -1,6 +1,7 @@
 import sys
-from ipaddress import ip_address, ip_network
-import requests
+import time
+import hashlib
+from LibPeerFrom.RangeIndex import RangeIndex
 from enum import Enum
 
 
@@ -12,10 +13,42 @@ class PingType(Enum):
     EstimateCountry = 4
     EstimateRegion = 5
     EstimateCity = 6
+    EstimateNearby = 7  # We're guessing from the nearest places we have accurate pings for
 
 this_module = sys.modules[__name__]
 global IPINFO_TOKEN
 IPINFO_TOKEN = ""
+# where geoip lookups go, and how long to wait for them. pointed at a local stand in for testing
+global IPINFO_URL
+IPINFO_URL = "https://ipinfo.io"
+global IPINFO_TIMEOUT
+IPINFO_TIMEOUT = 10
+# None pings with ping3, otherwise a function called like ping3.ping (e.g. a FakePinger)
+global PINGER
+PINGER = None
+# how many bytes of each sent payload are used to spot resends, 0 for the whole payload.
+# set from the capture profile, so a short snaplen still gives consistent digests
+global RESEND_PREFIX_BYTES
+RESEND_PREFIX_BYTES = 0
+
+# ip -> (unix time of lookup, GeoIP), so peers we meet again don't cost another ipinfo request
+global GEOIP_CACHE
+GEOIP_CACHE = dict()
+GEOIP_CACHE_SIZE = 4096
+GEOIP_CACHE_MAX_AGE_DAYS = 7
+
+def ping(address: str, unit: str = "ms", timeout: float = 1):
+    if this_module.PINGER is not None:
+        return this_module.PINGER(address, unit=unit, timeout=timeout)
+    # ping3 is only needed once we're pinging peers
+    from ping3 import ping
+    return ping(address, unit=unit, timeout=timeout)
+
+def payload_digest(payload: bytes) -> str:
+    # a short, fixed size stand in for a packet's payload, good enough to spot resends
+    if this_module.RESEND_PREFIX_BYTES > 0:
+        payload = payload[:this_module.RESEND_PREFIX_BYTES]
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
 
 class GeoIP:
     ip_addr: str
@@ -27,6 +60,9 @@ class GeoIP:
     timezone: str
     hostname: str
     org: str
+    status: int         # http status of the lookup, only 200s are cached
+    latitude: float     # None if ipinfo didn't give us a location
+    longitude: float
 
     def __repr__(self):
         s = ""
@@ -59,7 +95,10 @@ class GeoIP:
         if token != "": token = "?token="+token
         
         self.ip_addr = ip_addr
-        resp = requests.get(f"https://ipinfo.io/{ip_addr}/json{token}")
+        # requests is slow to import, and only needed once we've found a peer
+        import requests
+        resp = requests.get(f"{this_module.IPINFO_URL}/{ip_addr}/json{token}", timeout=this_module.IPINFO_TIMEOUT)
+        self.status = resp.status_code
         try:
             data = resp.json()
         except Exception as e:
@@ -74,6 +113,8 @@ class GeoIP:
         self.timezone = ""
         self.hostname = ""
         self.org = ""
+        self.latitude = None
+        self.longitude = None
 
         
         if 'region' in data.keys(): self.region = data['region']
@@ -82,6 +123,32 @@ class GeoIP:
         if 'timezone' in data.keys(): self.timezone = data['timezone']
         if 'org' in data.keys(): self.org = data['org']
         if 'hostname' in data.keys(): self.hostname = data['hostname']
+        if 'loc' in data.keys():
+            try:
+                self.latitude, self.longitude = [float(c) for c in data['loc'].split(",")]
+            except ValueError:
+                pass
+
+    @staticmethod
+    def lookup(ip_addr: str) -> "GeoIP":
+        # a GeoIP for ip_addr, from the cache if we've looked it up recently
+        cached = this_module.GEOIP_CACHE.get(ip_addr)
+        if cached is not None and time.time() - cached[0] < GEOIP_CACHE_MAX_AGE_DAYS * 86400:
+            return cached[1]
+        geoip = GeoIP(ip_addr)
+        # errors and rate limits are worth asking about again
+        if geoip.status != 200: return geoip
+        this_module.GEOIP_CACHE.pop(ip_addr, None)
+        this_module.GEOIP_CACHE[ip_addr] = (time.time(), geoip)
+        # the cache is in insertion order, so the first entry is the oldest lookup
+        while len(this_module.GEOIP_CACHE) > GEOIP_CACHE_SIZE:
+            del this_module.GEOIP_CACHE[next(iter(this_module.GEOIP_CACHE))]
+        return geoip
+
+    def location_key(self) -> str:
+        # ipinfo gives coordinates to 4 decimal places, so peers in the same place share a key
+        if self.latitude is None or self.longitude is None: return None
+        return f"{self.latitude:.4f},{self.longitude:.4f}"
 
 
     def __str__(self):
@@ -94,6 +161,27 @@ class GeoIP:
         else:
             return f"{self.region}, {self.country}"
 
+def generate_sparkline(points: list[tuple[float, float, float]], width: int = 120, height: int = 24,
+                       value_format: str = "{:.0f}") -> str:
+    # draws (min, mean, max) points as an inline svg: a line for the mean over a band for min/max.
+    # value_format is used for the values in the tooltip, e.g. "{:.0%}" for ratios
+    if points is None or len(points) == 0: return ""
+    low = min(p[0] for p in points)
+    high = max(p[2] for p in points)
+    span = high - low if high > low else 1
+    step = width / max(len(points) - 1, 1)
+    def y(value: float) -> str:
+        return f"{height - 1 - (value - low) / span * (height - 2):.1f}"
+    mean_line = " ".join(f"{i * step:.1f},{y(p[1])}" for i, p in enumerate(points))
+    band = " ".join(f"{i * step:.1f},{y(p[2])}" for i, p in enumerate(points)) + " " + \
+           " ".join(f"{i * step:.1f},{y(p[0])}" for i, p in reversed(list(enumerate(points))))
+    return f"<svg class=\"sparkline\" width=\"{width}\" height=\"{height}\" viewBox=\"0 0 {width} {height}\">" \
+           f"<title>{value_format.format(points[-1][1])} " \
+           f"(min {value_format.format(low)}, max {value_format.format(high)})</title>" \
+           f"<polygon points=\"{band}\" fill=\"currentColor\" fill-opacity=\"0.2\" stroke=\"none\"/>" \
+           f"<polyline points=\"{mean_line}\" fill=\"none\" stroke=\"currentColor\" stroke-width=\"1\"/>" \
+           "</svg>"
+
 def generate_html_view(headers: list[tuple[str, str]], peers) -> str:
     html =  "<!DOCTYPE html>" \
             "\n<html>" \
@@ -140,6 +228,9 @@ def generate_html_view(headers: list[tuple[str, str]], peers) -> str:
                     "\n        <td class=\"center_align\">Remote IP</td>" \
                     "\n        <td class=\"center_align\">Ping</td>" \
                     "\n        <td class=\"center_align\">Ping Type</td>" \
+                    "\n        <td class=\"center_align\">Ping History</td>" \
+                    "\n        <td class=\"center_align\">Packets/s</td>" \
+                    "\n        <td class=\"center_align\">Resends</td>" \
                     "\n        <td class=\"center_align\">Duration</td>" \
                     "\n        <td class=\"center_align\">GeoIP</td>" \
                     "\n        </tr>"\
@@ -155,6 +246,9 @@ def generate_html_view(headers: list[tuple[str, str]], peers) -> str:
                 "\n        <td class=\"left_align\"> " + f" {name} " + " </td>" \
                 "\n        <td class=\"center_align\"> " + f" {int(p.get_ping()):3} ms " + " </td>" \
                 "\n        <td class=\"center_align\"> " + f" {p.ping_type.name} " + " </td>" \
+                "\n        <td class=\"center_align\"> " + generate_sparkline(p.ping_history.downsample(p.HISTORY_POINTS)) + " </td>" \
+                "\n        <td class=\"center_align\"> " + generate_sparkline(p.packet_rate_history.downsample(p.HISTORY_POINTS)) + " </td>" \
+                "\n        <td class=\"center_align\"> " + generate_sparkline(p.resend_rate_history.downsample(p.HISTORY_POINTS), value_format="{:.0%}") + " </td>" \
                 "\n        <td class=\"center_align\"> " \
                     f" {int(duration.total_seconds()) // 60:02}:{int(duration.total_seconds()) % 60:02} " \
                 " </td>" \
@@ -170,31 +264,27 @@ def generate_html_view(headers: list[tuple[str, str]], peers) -> str:
 
     return html
     
+RESERVED_NETWORKS = [
+    '0.0.0.0/8',
+    '10.0.0.0/8',
+    '100.64.0.0/10',
+    '127.0.0.0/8',
+    '169.254.0.0/16',
+    '172.16.0.0/12',
+    '192.0.0.0/24',
+    '192.0.2.0/24',
+    '192.88.99.0/24',
+    '192.168.0.0/16',
+    '198.18.0.0/15',
+    '198.51.100.0/24',
+    '203.0.113.0/24',
+    '224.0.0.0/4',
+    '233.252.0.0/24',
+    '240.0.0.0/4',
+    '255.255.255.255/32'
+]
+# built once, rather than parsing every network for every packet
+RESERVED_RANGES = RangeIndex(networks=RESERVED_NETWORKS)
+
 def is_reserved_ip(address:str) -> bool:
-    ip = ip_address(address)
-    reserved_networks = [
-        '0.0.0.0/8',
-        '10.0.0.0/8',
-        '100.64.0.0/10',
-        '127.0.0.0/8',
-        '169.254.0.0/16',
-        '172.16.0.0/12',
-        '192.0.0.0/24',
-        '192.0.2.0/24',
-        '192.88.99.0/24',
-        '192.168.0.0/16',
-        '198.18.0.0/15',
-        '198.51.100.0/24',
-        '203.0.113.0/24',
-        '224.0.0.0/4',
-        '233.252.0.0/24',
-        '240.0.0.0/4',
-        '255.255.255.255/32'
-    ]
-    for net in reserved_networks:
-        if ip in ip_network(net):
-            return True
-
-    return False
-
-    
\ No newline at end of file
+    return address in RESERVED_RANGES
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# Load tests for the network facing parts (geoip lookups and pings), run against local stand ins
+# (FakeIpinfo and FakePinger) with injected latency, loss, errors and rate limits. For each peer
+# count it plays a few sessions of peers arriving, a maintenance run and the session ending, and
+# reports how long that took and how often the caches saved us the work. It then measures how
+# geoip lookups scale with concurrency.
+#
+#   python3 -m LibPeerFrom.LoadTest --peers=10,25,50 --ipinfo_latency_ms=80 --ping_loss=0.1
+import sys
+import time
+import random
+import getopt
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from LibPeerFrom import Helpers
+from LibPeerFrom.Helpers import GeoIP, PingType
+from LibPeerFrom.Peers import Peers
+from LibPeerFrom.PcapReader import PacketRecord
+from LibPeerFrom.FakeIpinfo import FakeIpinfo
+from LibPeerFrom.FakePinger import FakePinger, PingProfile
+
+LOCAL_IP = "10.0.0.50"
+
+
+def random_public_ip(rng: random.Random) -> str:
+    while True:
+        address = ".".join(str(rng.randrange(1, 255)) for _ in range(4))
+        if not Helpers.is_reserved_ip(address):
+            return address
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) == 0: return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def run_sessions(peer_count: int, sessions: int, repeat_rate: float, server: FakeIpinfo, pinger: FakePinger,
+                 rng: random.Random) -> dict:
+    # a fresh tool (empty caches) seeing `sessions` sessions of peer_count peers each.
+    # repeat_rate of each session's peers are people we've met before
+    Helpers.GEOIP_CACHE.clear()
+    peers = Peers(LOCAL_IP)
+    seen: list[str] = []
+    results = {"add_seconds": 0, "maintenance_seconds": [], "peers": 0, "lookups": 0, "estimated": 0,
+               "accurate": 0, "pings": 0, "estimate_hits": 0}
+    requests_before = server.requests
+    pings_before = pinger.pings
+    for session in range(sessions):
+        now = datetime.now()
+        addresses = set()
+        while len(addresses) < peer_count:
+            if len(seen) > 0 and rng.random() < repeat_rate:
+                addresses.add(rng.choice(seen))
+            else:
+                addresses.add(random_public_ip(rng))
+        started = time.perf_counter()
+        for address in addresses:
+            # a session start packet from the peer
+            peers.add_peer_from_packet(PacketRecord(address, LOCAL_IP, now, 102, ""))
+        results["add_seconds"] += time.perf_counter() - started
+        results["peers"] += len(peers)
+        results["estimated"] += len([p for p in peers if p.ping_type not in [PingType.NA, PingType.Guess, PingType.Accurate]])
+        seen += [a for a in addresses if a not in seen]
+
+        started = time.perf_counter()
+        peers.run_maintenance(now, persist=False)
+        results["maintenance_seconds"].append(time.perf_counter() - started)
+        results["accurate"] += len([p for p in peers if p.has_accurate_ping()])
+        # everyone leaves, and their pings go in the cache for the next session
+        peers.run_maintenance(now + timedelta(minutes=1), persist=False)
+    results["lookups"] = server.requests - requests_before
+    results["pings"] = pinger.pings - pings_before
+    results["estimate_hits"] = peers.ping_cache.hit_count
+    return results
+
+
+def run_lookups(count: int, concurrency: int, rng: random.Random) -> dict:
+    # count uncached geoip lookups, concurrency at a time
+    addresses = [random_public_ip(rng) for _ in range(count)]
+
+    def lookup(address: str) -> tuple[float, bool]:
+        # (seconds taken, whether it succeeded). counted by the caller, not from the pool's threads
+        started = time.perf_counter()
+        try:
+            ok = GeoIP(address).status == 200
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lookup, addresses))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for latency, _ in results]
+    return {"seconds": elapsed, "per_second": count / elapsed, "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95), "failures": len([ok for _, ok in results if not ok])}
+
+
+def usage():
+    print("LoadTest.py: load tests for geoip lookups and pings, against local stand ins")
+    print("usage: python3 -m LibPeerFrom.LoadTest [options]")
+    print("options:")
+    print(" --peers:                comma separated peer counts per session. default is 10,25,50")
+    print(" --sessions:             sessions per peer count. default is 3")
+    print(" --repeat_rate:          share of peers in a session we've met before. default is 0.3")
+    print(" --ipinfo_latency_ms:    fake ipinfo response time. default is 50")
+    print(" --ipinfo_jitter_ms:     up to this much more, at random. default is 20")
+    print(" --ipinfo_error_rate:    share of lookups that fail. default is 0")
+    print(" --ipinfo_rate_limit:    share of lookups that are rate limited. default is 0")
+    print(" --ipinfo_timeout:       geoip lookup timeout in seconds. default is 10")
+    print(" --ping_latency_ms:      fake ping time. default is 60, plus up to 200 depending on the address")
+    print(" --ping_jitter_ms:       up to this much more, at random. default is 10")
+    print(" --ping_loss:            share of pings that go unanswered (each costs the 1s timeout). default is 0.1")
+    print(" --concurrency:          comma separated concurrency levels for the lookup test. default is 1,4,16")
+    print(" --lookups:              lookups per concurrency level. default is 64")
+    print(" --seed:                 random seed. default is 1")
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "peers=", "sessions=", "repeat_rate=",
+                                                       "ipinfo_latency_ms=", "ipinfo_jitter_ms=", "ipinfo_error_rate=",
+                                                       "ipinfo_rate_limit=", "ipinfo_timeout=", "ping_latency_ms=",
+                                                       "ping_jitter_ms=", "ping_loss=", "concurrency=", "lookups=",
+                                                       "seed="])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        exit(2)
+    peer_counts = [10, 25, 50]
+    sessions = 3
+    repeat_rate = 0.3
+    ipinfo = {"latency_ms": 50, "jitter_ms": 20, "error_rate": 0, "rate_limit": 0}
+    ping = {"latency_ms": 60, "jitter_ms": 10, "loss": 0.1}
+    concurrency = [1, 4, 16]
+    lookups = 64
+    seed = 1
+    for o, a in opts:
+        if o in ["--help", "-h"]:
+            usage()
+            exit()
+        elif o in ["--peers"]:
+            peer_counts = [int(n) for n in a.split(",")]
+        elif o in ["--sessions"]:
+            sessions = int(a)
+        elif o in ["--repeat_rate"]:
+            repeat_rate = float(a)
+        elif o in ["--ipinfo_timeout"]:
+            Helpers.IPINFO_TIMEOUT = float(a)
+        elif o.startswith("--ipinfo_"):
+            ipinfo[o[len("--ipinfo_"):]] = float(a)
+        elif o.startswith("--ping_"):
+            ping[o[len("--ping_"):]] = float(a)
+        elif o in ["--concurrency"]:
+            concurrency = [int(n) for n in a.split(",")]
+        elif o in ["--lookups"]:
+            lookups = int(a)
+        elif o in ["--seed"]:
+            seed = int(a)
+
+    rng = random.Random(seed)
+    random.seed(seed)
+    server = FakeIpinfo(**ipinfo).start()
+    pinger = FakePinger(default=PingProfile(**ping), spread_ms=200)
+    Helpers.IPINFO_URL = server.url
+    Helpers.PINGER = pinger
+    print(f"fake ipinfo at {server.url}: {ipinfo}")
+    print(f"fake pings: {ping}, +0-200ms by address")
+    print("")
+
+    print("sessions of peers arriving, one maintenance run, then leaving (empty caches to start)")
+    print(f"{'peers':>6} {'add s':>8} {'ms/peer':>8} {'maint s':>8} {'max s':>7} {'lookups':>8} "
+          f"{'geoip hit':>10} {'estimated':>10} {'est hits':>9} {'accurate':>9} {'pings':>6}")
+    for peer_count in peer_counts:
+        r = run_sessions(peer_count, sessions, repeat_rate, server, pinger, rng)
+        total = max(r["peers"], 1)
+        print(f"{peer_count:>6} {r['add_seconds']:>8.2f} {1000 * r['add_seconds'] / total:>8.1f} "
+              f"{sum(r['maintenance_seconds']) / len(r['maintenance_seconds']):>8.2f} "
+              f"{max(r['maintenance_seconds']):>7.2f} {r['lookups']:>8} "
+              f"{1 - r['lookups'] / (peer_count * sessions):>10.0%} {r['estimated'] / total:>10.0%} "
+              f"{r['estimate_hits']:>9} {r['accurate'] / total:>9.0%} {r['pings']:>6}")
+    print("")
+
+    print(f"{lookups} uncached geoip lookups at each concurrency")
+    print(f"{'threads':>8} {'seconds':>8} {'per s':>8} {'p50 ms':>8} {'p95 ms':>8} {'failed':>7} {'server max':>11}")
+    for threads in concurrency:
+        server.max_concurrent = 0
+        r = run_lookups(lookups, threads, rng)
+        print(f"{threads:>8} {r['seconds']:>8.2f} {r['per_second']:>8.1f} {1000 * r['p50']:>8.0f} "
+              f"{1000 * r['p95']:>8.0f} {r['failures']:>7} {server.max_concurrent:>11}")
+    server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import struct
+from LibPeerFrom.Helpers import payload_digest
+from datetime import datetime
+from socket import inet_ntoa
+from typing import BinaryIO, Iterator
+
+# classic pcap magic numbers, mapped to (byte order, timestamp fraction units per second)
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1_000_000),
+    b"\xa1\xb2\xc3\xd4": (">", 1_000_000),
+    b"\x4d\x3c\xb2\xa1": ("<", 1_000_000_000),
+    b"\xa1\xb2\x3c\x4d": (">", 1_000_000_000),
+}
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+LINKTYPE_IPV4 = 228
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+
+class PacketRecord:
+    # a minimal stand in for a pyshark packet, carrying only what Peer/Peers read.
+    # packet['ip'], packet['udp'] and packet['data'] all return the record itself,
+    # so packet['ip'].src, packet['udp'].length and packet['data'].data all work.
+    __slots__ = ("src", "dst", "sniff_time", "length", "data")
+    src: str
+    dst: str
+    sniff_time: datetime
+    length: int     # udp length, including the 8 byte header
+    data: str       # digest of the udp payload, "" if there is no payload
+
+    def __init__(self, src: str, dst: str, sniff_time: datetime, length: int, data: str):
+        self.src = src
+        self.dst = dst
+        self.sniff_time = sniff_time
+        self.length = length
+        self.data = data
+
+    def __contains__(self, layer: str) -> bool:
+        if layer == "data": return self.data != ""
+        return layer in ("ip", "udp")
+
+    def __getitem__(self, layer: str) -> "PacketRecord":
+        if layer not in self: raise KeyError(layer)
+        return self
+
+    def __repr__(self):
+        return f"<PacketRecord {self.src} -> {self.dst} len:{self.length} at {self.sniff_time}>"
+
+
+class PcapReader:
+    # Reads a classic pcap stream (as written by tcpdump -w -) and yields IPv4 UDP packets
+    # as (timestamp, src, dst, udp_length, payload) tuples. src and dst are ints.
+    # Everything else is skipped without being dissected.
+    _stream: BinaryIO
+    _endian: str
+    _ts_units: int
+    linktype: int
+    snaplen: int
+
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+        header = self._read(24)
+        if header is None or header[:4] not in PCAP_MAGIC:
+            raise ValueError("Expected a classic pcap stream (tcpdump -w -)")
+        self._endian, self._ts_units = PCAP_MAGIC[header[:4]]
+        self.snaplen, self.linktype = struct.unpack(self._endian + "II", header[16:24])
+        self._record_header = struct.Struct(self._endian + "IIII")
+
+    def _read(self, size: int) -> bytes:
+        data = self._stream.read(size)
+        while data is not None and 0 < len(data) < size:
+            more = self._stream.read(size - len(data))
+            if not more: break
+            data += more
+        if not data or len(data) < size:
+            return None
+        return data
+
+    def _ip_offset(self, frame: bytes) -> int:
+        # returns the offset of the ipv4 header in the frame, or -1 if it isn't ipv4
+        if self.linktype == LINKTYPE_ETHERNET:
+            offset = 12
+            ethertype = int.from_bytes(frame[offset:offset + 2], "big")
+            while ethertype in ETHERTYPE_VLAN:
+                offset += 4
+                ethertype = int.from_bytes(frame[offset:offset + 2], "big")
+            return offset + 2 if ethertype == ETHERTYPE_IPV4 else -1
+        if self.linktype == LINKTYPE_LINUX_SLL:
+            return 16 if int.from_bytes(frame[14:16], "big") == ETHERTYPE_IPV4 else -1
+        if self.linktype == LINKTYPE_LINUX_SLL2:
+            return 20 if int.from_bytes(frame[0:2], "big") == ETHERTYPE_IPV4 else -1
+        if self.linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, 12, 14):
+            return 0
+        if self.linktype == LINKTYPE_NULL:
+            # address family is in the capturing host's byte order, AF_INET is 2 everywhere
+            return 4 if frame[0:4] in (b"\x02\x00\x00\x00", b"\x00\x00\x00\x02") else -1
+        return -1
+
+    def __iter__(self) -> Iterator[tuple[float, int, int, int, bytes]]:
+        while True:
+            header = self._read(16)
+            if header is None: return
+            ts_sec, ts_frac, incl_len, _ = self._record_header.unpack(header)
+            frame = self._read(incl_len)
+            if frame is None: return
+
+            ip = self._ip_offset(frame)
+            if ip < 0 or len(frame) < ip + 20: continue
+            if frame[ip] >> 4 != 4: continue
+            if frame[ip + 9] != 17: continue
+            # only the first fragment has a udp header
+            if int.from_bytes(frame[ip + 6:ip + 8], "big") & 0x1fff != 0: continue
+            udp = ip + (frame[ip] & 0x0f) * 4
+            if len(frame) < udp + 8: continue
+            udp_length = int.from_bytes(frame[udp + 4:udp + 6], "big")
+            payload = frame[udp + 8:udp + max(udp_length, 8)]
+            yield ts_sec + ts_frac / self._ts_units, \
+                  int.from_bytes(frame[ip + 12:ip + 16], "big"), \
+                  int.from_bytes(frame[ip + 16:ip + 20], "big"), \
+                  udp_length, payload
+
+    def records(self) -> Iterator[PacketRecord]:
+        for timestamp, src, dst, udp_length, payload in self:
+            yield PacketRecord(inet_ntoa(src.to_bytes(4, "big")), inet_ntoa(dst.to_bytes(4, "big")),
+                               datetime.fromtimestamp(timestamp), udp_length,
+                               payload_digest(payload) if len(payload) > 0 else "")
+
+    def batches(self, size: int = 4096) -> Iterator["PacketBatch"]:
+        rows = []
+        for row in self:
+            rows.append(row)
+            if len(rows) >= size:
+                yield PacketBatch.from_rows(rows)
+                rows = []
+        if len(rows) > 0:
+            yield PacketBatch.from_rows(rows)
+
+
+class PacketBatch:
+    # A columnar batch of udp packets, for Peers.add_packets. All arrays have one entry per packet,
+    # in capture order. payload_length is the udp payload length (from the udp header), and
+    # payload_hash is a 64 bit hash of the captured payload, 0 if there was no payload.
+    src: "np.ndarray"              # uint32 ipv4 addresses
+    dst: "np.ndarray"
+    timestamp: "np.ndarray"        # float64 unix timestamps
+    payload_length: "np.ndarray"   # int32
+    payload_hash: "np.ndarray"     # uint64
+
+    def __init__(self, src, dst, timestamp, payload_length, payload_hash):
+        import numpy as np
+        self.src = np.asarray(src, dtype=np.uint32)
+        self.dst = np.asarray(dst, dtype=np.uint32)
+        self.timestamp = np.asarray(timestamp, dtype=np.float64)
+        self.payload_length = np.asarray(payload_length, dtype=np.int32)
+        self.payload_hash = np.asarray(payload_hash, dtype=np.uint64)
+        if not len(self.src) == len(self.dst) == len(self.timestamp) == len(self.payload_length) == len(self.payload_hash):
+            raise ValueError("Batch columns have different lengths")
+
+    @staticmethod
+    def from_rows(rows: list[tuple[float, int, int, int, bytes]]) -> "PacketBatch":
+        # from PcapReader's (timestamp, src, dst, udp_length, payload) tuples
+        return PacketBatch([r[1] for r in rows], [r[2] for r in rows], [r[0] for r in rows],
+                           [r[3] - 8 for r in rows],
+                           [int(payload_digest(r[4]), 16) if len(r[4]) > 0 else 0 for r in rows])
+
+    def record(self, i: int) -> PacketRecord:
+        # a single packet from the batch, as add_peer_from_packet would see it
+        return PacketRecord(inet_ntoa(int(self.src[i]).to_bytes(4, "big")), inet_ntoa(int(self.dst[i]).to_bytes(4, "big")),
+                            datetime.fromtimestamp(float(self.timestamp[i])), int(self.payload_length[i]) + 8,
+                            f"{int(self.payload_hash[i]):016x}" if self.payload_hash[i] != 0 else "")
+
+    def __len__(self) -> int:
+        return len(self.src)
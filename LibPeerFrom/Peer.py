@@ -1,9 +1,24 @@
-import pyshark
-from ping3 import ping
-from LibPeerFrom.Helpers import GeoIP, PingType
+from LibPeerFrom.Helpers import GeoIP, PingType, payload_digest, ping
+from LibPeerFrom.PcapReader import PacketRecord
+from LibPeerFrom.TimeSeries import RingSeries
 from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # only needed for annotations, pyshark is slow to import
+    import pyshark
+
+def to_microseconds(timestamp: datetime) -> int:
+    # an exact unix timestamp in microseconds, without going through a float
+    return round(timestamp.replace(microsecond=0).timestamp()) * 1_000_000 + timestamp.microsecond
 
 class Peer:
+    # how many samples of history we keep per series, and how often packet/resend rates are sampled
+    HISTORY_LENGTH = 120
+    HISTORY_INTERVAL = timedelta(seconds=5)
+    # how many points the history is reduced to for display
+    HISTORY_POINTS = 30
+
     ping_type: PingType
     local_ip: str
     packet_data_sent: set[str]
@@ -17,12 +32,21 @@ class Peer:
     ping: float
     geoip: GeoIP
     friendly_name:str
+    estimate_version: tuple     # the ping cache version our estimate was worked out at, see Peers.estimate_peer
+    ping_history: RingSeries
+    packet_rate_history: RingSeries
+    resend_rate_history: RingSeries
+    _interval_start: datetime
+    _interval_packets: int
+    _interval_sent: int
+    _interval_resent: int
 
 
-    def __init__(self, local_ip: str, packet: pyshark.packet):
+    def __init__(self, local_ip: str, packet: "pyshark.packet"):
         if 'udp' not in packet: return None
         self.friendly_name = ""
         self.ping_type = PingType.NA
+        self.estimate_version = None
         self.local_ip = local_ip
         self.packet_data_sent = set()
         self.packets_resent = 0
@@ -31,7 +55,7 @@ class Peer:
             self.packets_sent = 1
             self.packets_received = 0
             if 'data' in packet:
-                self.packet_data_sent.add(packet['data'].data)
+                self.packet_data_sent.add(self.payload_key(packet))
         elif packet['ip'].dst == local_ip: 
             self.remote_ip = packet['ip'].src
             self.packets_received = 1
@@ -42,38 +66,115 @@ class Peer:
         self.times_seen = 1
         self.ping = -1
         self.geoip = None
+        self.ping_history = RingSeries(self.HISTORY_LENGTH)
+        self.packet_rate_history = RingSeries(self.HISTORY_LENGTH)
+        self.resend_rate_history = RingSeries(self.HISTORY_LENGTH)
+        self._interval_start = self.first_seen
+        self._interval_packets = 1
+        self._interval_sent = self.packets_sent
+        self._interval_resent = 0
    
-    def just_seen(self, packet: pyshark.packet) -> int:
+    @staticmethod
+    def payload_key(packet: "pyshark.packet") -> str:
+        # PacketRecords already carry a digest, pyshark gives us the (possibly truncated) payload as hex
+        if isinstance(packet, PacketRecord): return packet['data'].data
+        return payload_digest(bytes.fromhex(packet['data'].data.replace(":", "")))
+
+    def just_seen(self, packet: "pyshark.packet") -> int:
         if 'udp' not in packet: return None
         self.estimate_geoip()
+        self.sample_rates(packet.sniff_time)
         if packet['ip'].src == self.local_ip:
             self.packets_sent += 1
+            self._interval_sent += 1
             if 'data' in packet:
-                if packet['data'].data in self.packet_data_sent:
+                key = self.payload_key(packet)
+                if key in self.packet_data_sent:
                     self.packets_resent += 1
+                    self._interval_resent += 1
                 else:
-                    self.packet_data_sent.add(packet['data'].data)
+                    self.packet_data_sent.add(key)
         elif packet['ip'].dst == self.local_ip:
             self.packets_received += 1
         else:
             return None
+        self._interval_packets += 1
         if  self.ping_type == PingType.NA:
             guess = (packet.sniff_time - self.first_seen)/timedelta(milliseconds=1)
             if guess > 5: 
-                self.ping = guess # assume we'll never be below 5ms
-                self.ping_type = PingType.Guess
+                # assume we'll never be below 5ms
+                self.set_ping(guess, PingType.Guess, packet.sniff_time)
         self.last_seen = packet.sniff_time
         self.times_seen += 1
         
         return self.times_seen
 
+    def just_seen_many(self, timestamps, outgoing, payload_hashes) -> int:
+        # the batch equivalent of just_seen, for numpy arrays of this peer's packets in capture order:
+        # unix timestamps, whether each was sent by us, and payload hashes (0 for no payload).
+        # leaves the peer exactly as calling just_seen for each packet would
+        import numpy as np
+        if len(timestamps) == 0: return self.times_seen
+        self.estimate_geoip()
+        # microseconds, rounded the same way datetime.fromtimestamp rounds them
+        fraction, whole = np.modf(timestamps)
+        times_us = whole.astype(np.int64) * 1_000_000 + np.round(fraction * 1e6).astype(np.int64)
+
+        # a sent payload is a resend if we'd seen it before this batch, or earlier in this batch
+        resent = np.zeros(len(timestamps), dtype=bool)
+        with_data = np.flatnonzero(outgoing & (payload_hashes != 0))
+        if len(with_data) > 0:
+            hashes, first = np.unique(payload_hashes[with_data], return_index=True)
+            digests = [f"{h:016x}" for h in hashes.tolist()]
+            flags = np.ones(len(with_data), dtype=bool)
+            flags[first] = [d in self.packet_data_sent for d in digests]
+            resent[with_data] = flags
+            self.packet_data_sent.update(digests)
+
+        # which rate interval each packet lands in, counted from the current one. just_seen only
+        # ever moves the interval forward, so a late packet counts towards the latest interval
+        interval_us = self.HISTORY_INTERVAL // timedelta(microseconds=1)
+        start_us = to_microseconds(self._interval_start)
+        intervals = np.maximum.accumulate(np.maximum((times_us - start_us) // interval_us, 0))
+        packets_per = np.bincount(intervals)
+        sent_per = np.bincount(intervals, weights=outgoing)
+        resent_per = np.bincount(intervals, weights=resent)
+        packets_per[0] += self._interval_packets
+        sent_per[0] += self._interval_sent
+        resent_per[0] += self._interval_resent
+        current = 0
+        for i in np.flatnonzero(packets_per[1:]).tolist():
+            self._interval_packets = int(packets_per[current])
+            self._interval_sent = int(sent_per[current])
+            self._interval_resent = int(resent_per[current])
+            self.sample_rates(self._interval_start + (i + 1 - current) * self.HISTORY_INTERVAL)
+            current = i + 1
+        self._interval_packets = int(packets_per[current])
+        self._interval_sent = int(sent_per[current])
+        self._interval_resent = int(resent_per[current])
+
+        sent = int(np.count_nonzero(outgoing))
+        self.packets_sent += sent
+        self.packets_received += len(timestamps) - sent
+        self.packets_resent += int(np.count_nonzero(resent))
+        if self.ping_type == PingType.NA:
+            since_first_us = times_us - to_microseconds(self.first_seen)
+            guesses = np.flatnonzero(since_first_us > 5000)
+            if len(guesses) > 0:
+                # assume we'll never be below 5ms
+                self.set_ping(int(since_first_us[guesses[0]]) / 1000, PingType.Guess,
+                              datetime.fromtimestamp(float(timestamps[guesses[0]])))
+        self.last_seen = datetime.fromtimestamp(float(timestamps[-1]))
+        self.times_seen += len(timestamps)
+
+        return self.times_seen
+
     def ping_host(self) -> float:
         if not self.has_accurate_ping():
             # if we're not sure that we'll get a response, do it once
             p = ping(self.remote_ip, unit="ms", timeout = 1)
             if isinstance(p, float):
-                self.ping_type = PingType.Accurate
-                self.ping = p
+                self.set_ping(p, PingType.Accurate)
         else:
             # otherwise, do three pings and average
             total_ping = 0
@@ -84,12 +185,38 @@ class Peer:
                     total_ping += p
                     ping_count += 1
             if ping_count > 0:
-                self.ping = total_ping / ping_count
+                self.set_ping(total_ping / ping_count, PingType.Accurate)
         return self.ping
+
+    def set_ping(self, ping: float, ping_type: PingType, timestamp: datetime = None) -> None:
+        if timestamp is None: timestamp = datetime.now()
+        self.ping = ping
+        self.ping_type = ping_type
+        self.ping_history.append(timestamp.timestamp(), ping)
+
+    def sample_rates(self, timestamp: datetime) -> None:
+        # closes off the current rate interval (and any idle ones since) once it has ended
+        elapsed = timestamp - self._interval_start
+        if elapsed < self.HISTORY_INTERVAL: return
+        interval_seconds = self.HISTORY_INTERVAL.total_seconds()
+        self.packet_rate_history.append(self._interval_start.timestamp(), self._interval_packets / interval_seconds)
+        if self._interval_sent > 0:
+            self.resend_rate_history.append(self._interval_start.timestamp(), self._interval_resent / self._interval_sent)
+        else:
+            self.resend_rate_history.append(self._interval_start.timestamp(), 0)
+        idle_intervals = min(int(elapsed / self.HISTORY_INTERVAL) - 1, self.HISTORY_LENGTH)
+        for i in range(1, idle_intervals + 1):
+            idle_start = (self._interval_start + i * self.HISTORY_INTERVAL).timestamp()
+            self.packet_rate_history.append(idle_start, 0)
+            self.resend_rate_history.append(idle_start, 0)
+        self._interval_start += int(elapsed / self.HISTORY_INTERVAL) * self.HISTORY_INTERVAL
+        self._interval_packets = 0
+        self._interval_sent = 0
+        self._interval_resent = 0
             
     def estimate_geoip(self) -> GeoIP:
         if self.geoip is None:
-            self.geoip = GeoIP(self.remote_ip)
+            self.geoip = GeoIP.lookup(self.remote_ip)
         return self.geoip
 
     def has_accurate_ping(self) -> bool:
@@ -132,4 +259,8 @@ class Peer:
         peer_dict["geoip"] = str(self.geoip)
         peer_dict["friendly_name"] = self.friendly_name
         peer_dict["duration"] = f" {int(duration.total_seconds()) // 60:02}:{int(duration.total_seconds()) % 60:02} "
+        # history is [min, mean, max] per point, oldest first
+        peer_dict["ping_history"] = [list(p) for p in self.ping_history.downsample(self.HISTORY_POINTS)]
+        peer_dict["packet_rate_history"] = [list(p) for p in self.packet_rate_history.downsample(self.HISTORY_POINTS)]
+        peer_dict["resend_rate_history"] = [list(p) for p in self.resend_rate_history.downsample(self.HISTORY_POINTS)]
         return peer_dict
@@ -1,21 +1,40 @@
 from LibPeerFrom.Peer import Peer
 from LibPeerFrom.PingCache import PingCache, PingCacheEstimate, PingAccuracy
+from LibPeerFrom.SessionArchive import SessionArchive
 from LibPeerFrom.Helpers import PingType, is_reserved_ip
-from pyshark import packet
+from LibPeerFrom.RangeIndex import RangeIndex
+from LibPeerFrom.FriendlyNames import FriendlyNames
+from LibPeerFrom.PcapReader import PacketBatch
+from LibPeerFrom import Helpers
 from datetime import datetime, timedelta
-from typing import Union, Iterator
+from typing import Union, Iterator, TYPE_CHECKING
+from ipaddress import ip_address
+from socket import inet_ntoa
 import sys
 
+if TYPE_CHECKING:
+    # only needed for annotations, pyshark is slow to import
+    from pyshark import packet
+
 
 class Peers:
+    # peers we don't have an accurate ping for, whose ping can come from the cache
+    ESTIMATABLE_PING_TYPES = [PingType.NA, PingType.Guess, PingType.Estimate, PingType.EstimateCountry,
+                              PingType.EstimateRegion, PingType.EstimateCity, PingType.EstimateNearby]
+
     _storage: list[Peer]
     _index: set[str]
     _local_ip: str
     sortmode: str
     sortorder: str
     ping_cache: PingCache
+    session_archive: Union[None, SessionArchive]
+    server_ranges: RangeIndex
+    friendly_names: Union[None, FriendlyNames]
 
-    def __init__(self, local_ip, sortmode="last_seen", sortorder="descending", cacheFileName: str = ""):
+    def __init__(self, local_ip, sortmode="last_seen", sortorder="descending", cacheFileName: str = "",
+                 archiveFileName: str = "", archiveRetentionDays: int = 0, serverRangeFiles: list[str] = None,
+                 friendlyNameFileName: str = ""):
         if sortmode.lower() not in ["first_seen", "last_seen", "ip", "ping"]: raise ValueError("Invalid sortmode specified")
         if sortorder.lower() not in ["ascending", "descending"]: raise ValueError("Invalid sortorder specified")
         self._storage = list()
@@ -24,6 +43,14 @@ class Peers:
         self.sortmode = sortmode.lower()
         self.sortorder = sortorder.lower()
         self.ping_cache = PingCache(cacheFileName)
+        self.session_archive = None
+        if archiveFileName != "":
+            self.session_archive = SessionArchive(archiveFileName, archiveRetentionDays)
+        # relay/matchmaking servers, from provider range files plus any we've rejected after a geoip lookup
+        self.server_ranges = RangeIndex(serverRangeFiles)
+        self.friendly_names = None
+        if friendlyNameFileName != "":
+            self.friendly_names = FriendlyNames(friendlyNameFileName)
 
     def is_private_ip(self, addr: str) -> bool:
         return is_reserved_ip(addr)
@@ -34,27 +61,51 @@ class Peers:
     def persist_cache(self) -> None:
         return self.ping_cache.persist_cache()
 
+    def name_peer(self, peer: Peer) -> None:
+        if self.friendly_names is None: return
+        peer.friendly_name = self.friendly_names.name_for(peer.remote_ip)
+        self.friendly_names.add_ip(peer.remote_ip)
+
+    def update_friendly_names(self) -> None:
+        # picks up any edits to the friendly name file, adds peers we've seen since the last update
+        # and drops unnamed ones that have gone
+        if self.friendly_names is None: return
+        if self.friendly_names.reload_if_changed():
+            for p in self._storage:
+                p.friendly_name = self.friendly_names.name_for(p.remote_ip)
+        self.friendly_names.flush(self.get_index())
+
     def add_peer(self, peer: Peer) -> None:
         if  not self.peer_known(peer) \
             and not self.is_private_ip(peer.remote_ip):
+            self.name_peer(peer)
+            # new peers are estimated straight away, rather than at the next maintenance
+            self.estimate_peer(peer)
             self._storage.append(peer)
             self._index = {p.remote_ip for p in self._storage}
             self.sort_peers()
 
     # returns a peer if it was added, None if no peer was added
-    def add_peer_from_packet(self, packet: packet) -> Union[None,Peer]:
-        peer = Peer(self.local_ip, packet)
-        if self.is_private_ip(peer.remote_ip):
+    def add_peer_from_packet(self, packet: "packet") -> Union[None,Peer]:
+        # work out who the packet is from before building a Peer, so known peers cost nothing extra
+        if packet['ip'].src == self.local_ip: remote_ip = packet['ip'].dst
+        elif packet['ip'].dst == self.local_ip: remote_ip = packet['ip'].src
+        else: raise ValueError("No Local IP Address Found")
+        if self.is_private_ip(remote_ip):
             return None
-        if self.peer_known(peer):
-            self[peer.remote_ip].just_seen(packet)  
+        if remote_ip in self._index:
+            self[remote_ip].just_seen(packet)  
             return None
         else:
-            # packet['data'].data is a string, it has double the length of the actual data
-            # as it uses two chars to represent each byte
             # we consider 94 byte packets to be the start of a session
-            # udp payload is 281 for 94 bytes based on wireshark trace
-            if len(packet['udp'].payload) == 281: 
+            # udp length includes the 8 byte udp header, so 102 for 94 bytes of payload
+            # (this is equivalent to len(packet['udp'].payload) == 281 in wireshark's
+            # colon separated hex, but doesn't depend on the payload being captured)
+            if int(packet['udp'].length) == 102: 
+                # known servers are skipped before we pay for a Peer or a geoip lookup
+                if remote_ip in self.server_ranges:
+                    return None
+                peer = Peer(self.local_ip, packet)
                 try:
                     peer.estimate_geoip()
                 except:
@@ -64,25 +115,100 @@ class Peers:
                 if "amazon" not in peer.geoip.org.lower():
                     self.add_peer(peer)  
                     return peer
+                self.server_ranges.add_address(remote_ip)
       
-    def estimate_guess_peers(self) -> None:
+    # the batch equivalent of add_peer_from_packet, for replaying captures or handling bursts.
+    # packets must be in capture order. returns the peers added, in the order they were added
+    def add_packets(self, batch: PacketBatch) -> list[Peer]:
+        import numpy as np
+        if len(batch) == 0: return []
+        local = int(ip_address(self.local_ip))
+        outgoing = batch.src == local
+        if not np.all(outgoing | (batch.dst == local)):
+            raise ValueError("No Local IP Address Found")
+        remote = np.where(outgoing, batch.dst, batch.src)
+
+        # group the packets by peer, keeping capture order within each group
+        rows = np.flatnonzero(~Helpers.RESERVED_RANGES.contains_many(remote))
+        rows = rows[np.argsort(remote[rows], kind="stable")]
+        groups = np.split(rows, np.flatnonzero(np.diff(remote[rows])) + 1) if len(rows) > 0 else []
+
+        added: list[tuple[int, Peer]] = []
+        last_packet: dict[str, int] = dict()
+        for group in groups:
+            remote_ip = inet_ntoa(int(remote[group[0]]).to_bytes(4, "big"))
+            if remote_ip in self._index:
+                peer = self[remote_ip]
+            else:
+                # same as add_peer_from_packet: a peer starts at its first 94 byte packet,
+                # unless it's a server, or we can't look it up (in which case we try the next one)
+                peer = None
+                for start in group[batch.payload_length[group] == 94].tolist():
+                    if remote_ip in self.server_ranges: break
+                    candidate = Peer(self.local_ip, batch.record(start))
+                    try:
+                        candidate.estimate_geoip()
+                    except:
+                        print("Error getting geoip for",candidate.get_name())
+                        sys.stdout.flush()
+                        continue
+                    if "amazon" not in candidate.geoip.org.lower():
+                        # estimated before its packets, as add_peer_from_packet would have
+                        self.estimate_peer(candidate)
+                        peer = candidate
+                        added.append((start, peer))
+                        group = group[group > start]
+                    else:
+                        self.server_ranges.add_address(remote_ip)
+                    break
+                if peer is None: continue
+            if len(group) > 0:
+                peer.just_seen_many(batch.timestamp[group], outgoing[group], batch.payload_hash[group])
+                last_packet[peer.remote_ip] = int(group[-1])
+
+        for start, peer in sorted(added, key=lambda a: a[0]):
+            self.add_peer(peer)
+        if len(added) > 0:
+            # adding a peer sorts, which truncates everyone's last_seen. only peers seen after the
+            # last addition would have kept their microseconds
+            last_added = max(start for start, _ in added)
+            for remote_ip, i in last_packet.items():
+                if i > last_added:
+                    self[remote_ip].last_seen = datetime.fromtimestamp(float(batch.timestamp[i]))
+        return [peer for _, peer in sorted(added, key=lambda a: a[0])]
+
+    def estimate_peer(self, peer: Peer) -> None:
+        # estimates a peer we don't have an accurate ping for. the estimate is only worked out again
+        # once the cache entries it could depend on have changed, so this is cheap to call often
+        if peer.ping_type not in self.ESTIMATABLE_PING_TYPES or peer.geoip is None: return
+        if peer.estimate_version == self.ping_cache.estimate_version(peer.geoip):
+            # the peer's estimate is still current, which is still a use of the keys it came from
+            self.ping_cache.mark_estimate_used(peer.geoip)
+            return
+        est: PingCacheEstimate = self.ping_cache.estimate_peer(peer)
+        # what the estimate depends on depends on how it was made, so the version is taken afterwards
+        peer.estimate_version = self.ping_cache.estimate_version(peer.geoip)
+        if est.Accuracy != PingAccuracy.NA \
+        and est.Estimate.Mean is not None \
+        and est.Estimate.Mean > 0:
+            ping_type = PingType.Estimate
+            if est.Accuracy == PingAccuracy.Country:
+                ping_type = PingType.EstimateCountry
+            if est.Accuracy == PingAccuracy.Region:
+                ping_type = PingType.EstimateRegion
+            if est.Accuracy == PingAccuracy.City:
+                ping_type = PingType.EstimateCity
+            if est.Accuracy == PingAccuracy.Nearby:
+                ping_type = PingType.EstimateNearby
+            if peer.ping_type != ping_type or peer.ping != est.Estimate.Mean:
+                peer.set_ping(est.Estimate.Mean, ping_type)
+
+    def refresh_estimates(self) -> None:
         peer: Peer
-        for peer in [p for p in self._storage if p.ping_type == PingType.Guess]:
-            est: PingCacheEstimate = self.ping_cache.estimate_peer(peer)
-            if est.Accuracy != PingAccuracy.NA \
-            and est.Estimate.Mean is not None \
-            and est.Estimate.Mean > 0:
-                self.ping_cache.add_peer(peer)
-                self[peer.remote_ip].ping = est.Estimate.Mean
-                self[peer.remote_ip].ping_type = PingType.Estimate
-                if est.Accuracy == PingAccuracy.Country:
-                    self[peer.remote_ip].ping_type = PingType.EstimateCountry
-                if est.Accuracy == PingAccuracy.Region:
-                    self[peer.remote_ip].ping_type = PingType.EstimateRegion
-                if est.Accuracy == PingAccuracy.City:
-                    self[peer.remote_ip].ping_type = PingType.EstimateCity
-
-    def peer_known_from_packet(self, packet:packet) -> bool:
+        for peer in self._storage:
+            self.estimate_peer(peer)
+
+    def peer_known_from_packet(self, packet: "packet") -> bool:
         if 'udp' not in packet: return False
         if packet['ip'].dst in self._index: return True
         if packet['ip'].src in self._index: return True
@@ -98,6 +224,8 @@ class Peers:
         if peer in self:
             if peer.ping_type in [PingType.Guess, PingType.Accurate]:
                 self.ping_cache.add_peer(peer)
+            if self.session_archive is not None:
+                self.session_archive.record(peer)
             self._storage.remove(peer)                 
             self._index = { p.remote_ip for p in self._storage }
         self.sort_peers()
@@ -132,6 +260,33 @@ class Peers:
                 p.last_seen = p.last_seen.replace(microsecond=0)
             self._storage.sort(reverse=not ascending, key= lambda p: p.last_seen)
 
+    def maintenance_due(self, last_maintenance_time: datetime, timestamp: datetime) -> bool:
+        since_last_maint = timestamp - last_maintenance_time
+        # run maintenance every 20 seconds, as long as there's peers
+        if since_last_maint.total_seconds() > 20 and len(self) > 0:
+            return True
+        # run maintenance every 10 minutes if there's no peers
+        # in minute {0,10,20,30,40,50}
+        if since_last_maint.total_seconds() > 600 and timestamp.minute % 10 == 0:
+            return True
+        return False
+
+    def run_maintenance(self, timestamp: datetime, persist: bool = True) -> None:
+        self.server_ranges.reload_if_changed()
+        # remove all peers that haven't been seen in the last 30s
+        self.remove_stale_peers(timestamp - timedelta(seconds=30))
+        self.ping_peers()
+        self.ping_cache.apply_minimum_pings()
+        self.ping_cache.compact()
+        self.refresh_estimates()
+        if persist:
+            self.persist_cache()
+        self.update_friendly_names()
+        # Cache all our accurate peers every 10 minutes
+        # This means that accurate peers will have more entries in the cache
+        if timestamp.minute % 10 == 0:
+            self.cache_accurate_peers()
+
     def cache_accurate_peers(self):
         peer: Peer
         for peer in self._storage:
@@ -1,8 +1,14 @@
 from LibPeerFrom.Helpers import PingType, GeoIP
 from LibPeerFrom.Peer import Peer
+from LibPeerFrom.SpatialIndex import KDTree, to_unit_vector, chord_to_km
 from enum import Enum
+from math import exp, log
+from weakref import WeakKeyDictionary
 
 import json
+import os
+import random
+import time
 
 
 class PingAccuracy(Enum):
@@ -10,6 +16,7 @@ class PingAccuracy(Enum):
     City = 1
     Region = 2
     Country = 3
+    Nearby = 4
     NA = 999
 
 class PingEstimate:
@@ -27,28 +34,80 @@ class PingEstimate:
 class PingCacheEstimate:
     Estimate: PingEstimate
     Accuracy: PingAccuracy
+    Confidence: float   # 0-1, only set for PingAccuracy.Nearby
+    Keys: list[str]     # the cache keys the estimate came from
 
     def __init__(self):
         self.Estimate = PingEstimate()
         self.Accuracy = PingAccuracy.NA
+        self.Confidence = None
+        self.Keys = []
 
     def __str__(self):
-        return f"(Accuracy: {str(self.Accuracy)}; Estimate: {str(self.Estimate)})"
+        return f"(Accuracy: {str(self.Accuracy)}; Confidence: {self.Confidence}; Estimate: {str(self.Estimate)})"
 
     def __repr__(self):
-        return f"<Accuracy: {self.Accuracy.__repr__()}; Estimate: {self.Estimate.__repr__()}>"
+        return f"<Accuracy: {self.Accuracy.__repr__()}; Confidence: {self.Confidence}; Estimate: {self.Estimate.__repr__()}>"
 
 class PingCache:
+    # nearby estimates use the nearest_k closest places with accurate pings, no further than
+    # nearest_max_distance_km away, and only if we're at least nearest_min_confidence sure
+    nearest_k = 5
+    nearest_max_distance_km = 500
+    nearest_min_confidence = 0.3
+    # distances (km) are softened by this much when weighting, so a sample 0km away doesn't dominate
+    nearest_distance_softening_km = 25
+    # confidence halves roughly every this many km of (weighted) distance
+    nearest_confidence_distance_km = 250
 
-    _storage: dict[str,list[float]]
+    # a sample's weight in the mean halves every decay_half_life_days
+    decay_half_life_days = 30
+    # each key keeps its max_samples_per_key most recent samples, none older than max_sample_age_days
+    max_samples_per_key = 50
+    max_sample_age_days = 365
+    # keys that haven't been added to or used for an estimate in key_expiry_days are dropped
+    key_expiry_days = 180
+    # how often maintenance compacts the cache
+    compaction_interval_seconds = 3600
+    # how many locations' estimates are kept
+    max_cached_estimates = 4096
+    # how many location changes are remembered for working out which nearby estimates they affect
+    max_location_changes = 1024
+
+    # samples are [ping, unix timestamp] pairs
+    _storage: dict[str,list[list[float]]]
+    _locations: dict[str,list[list[float]]]   # "country; lat,lon" -> accurate pings
+    _last_used: dict[str,float]                # key (from either) -> unix timestamp
+    _last_compaction: float
+    _spatial_index: KDTree
     _fileName: str
     hit_count: int
+    # estimates are cached per location, and only recomputed once the samples behind them change.
+    # _version counts changes to the cache, _versions holds the change each key was last changed at
+    # (keys that have gone have no entry). location changes are also kept in _location_changes as
+    # (version, unit vector), so a change only affects the nearby estimates it's close enough to
+    # be part of. changes older than _location_changes_floor have been forgotten.
+    # decay over a session is tiny next to decay_half_life_days, so time alone doesn't invalidate them
+    _version: int
+    _versions: dict[str,int]
+    _location_changes: list[tuple[int, tuple[float, float, float]]]
+    _location_changes_floor: int
+    _nearby_versions: dict[str, tuple[int, int]]    # location key -> (checked at version, last nearby change)
+    _epoch: int     # tells this cache's versions apart from any other's, e.g. after a restore
+    _estimates: dict[tuple, tuple[tuple, PingCacheEstimate]]
+    _keys: WeakKeyDictionary    # GeoIP -> (city, region, country, location) keys
 
     def __init__(self, fileName: str = ""):
         self._storage = dict()
+        self._locations = dict()
+        self._last_used = dict()
+        self._last_compaction = 0
+        self._spatial_index = None
         self._fileName = fileName
         self.hit_count = 0
         self.minimum_pings = dict()
+        self._keys = WeakKeyDictionary()
+        self._reset_versions()
         
 
     def has_backing_cache(self):
@@ -61,85 +120,308 @@ class PingCache:
             if peer.geoip.region is None: return
             if peer.geoip.country is None: return
 
-            keys: list[str] = [ f"{peer.geoip.country}, {peer.geoip.region}, {peer.geoip.city}",\
-                                f"{peer.geoip.country}, {peer.geoip.region}", \
-                                f"{peer.geoip.country}"]
-            for key in keys:
+            cityKey, regionKey, countryKey, locationKey = self.cache_keys(peer.geoip)
+            for key in [cityKey, regionKey, countryKey]:
                 self.upsert(key, peer.ping)
+            if locationKey is not None:
+                self.upsert_location(locationKey, peer.ping)
+
+    def cache_keys(self, geoip: GeoIP) -> tuple[str, str, str, str]:
+        # (city, region, country, location) keys for a GeoIP. location is None if it has no coordinates
+        keys = self._keys.get(geoip)
+        if keys is None:
+            location = geoip.location_key()
+            keys = (f"{geoip.country}, {geoip.region}, {geoip.city}",
+                    f"{geoip.country}, {geoip.region}",
+                    f"{geoip.country}",
+                    f"{geoip.country}; {location}" if location is not None else None)
+            self._keys[geoip] = keys
+        return keys
+
+    def _reset_versions(self) -> None:
+        # everything has changed, e.g. the whole cache was replaced
+        self._version = 1
+        self._epoch = random.getrandbits(32)
+        self._versions = {key: self._version for key in list(self._storage.keys()) + list(self._locations.keys())}
+        self._location_changes = []
+        self._location_changes_floor = self._version
+        self._nearby_versions = dict()
+        self._estimates = dict()
+        self._spatial_index = None
+
+    def _changed(self, key: str, location: bool = False) -> None:
+        # call whenever a key's samples change, or it's removed
+        self._version += 1
+        if key in self._storage or key in self._locations:
+            self._versions[key] = self._version
+        else:
+            self._versions.pop(key, None)
+        if location:
+            self._location_changes.append((self._version, to_unit_vector(*self._key_coordinates(key))))
+            if len(self._location_changes) > self.max_location_changes:
+                forgotten = len(self._location_changes) - self.max_location_changes // 2
+                self._location_changes_floor = self._location_changes[forgotten - 1][0]
+                del self._location_changes[:forgotten]
+            # the tree is rebuilt on the next nearby estimate
+            self._spatial_index = None
+
+    def _nearby_version(self, locationKey: str, latitude: float, longitude: float) -> int:
+        # the last change to any location close enough to be part of a nearby estimate for here.
+        # only changes since we last checked are looked at
+        checked, version = self._nearby_versions.get(locationKey, (0, 0))
+        if checked < self._location_changes_floor:
+            checked, version = 0, self._location_changes_floor
+        target = to_unit_vector(latitude, longitude)
+        for change, point in reversed(self._location_changes):
+            if change <= checked: break
+            chord = ((point[0] - target[0]) ** 2 + (point[1] - target[1]) ** 2 + (point[2] - target[2]) ** 2) ** 0.5
+            if chord_to_km(chord) <= self.nearest_max_distance_km:
+                version = max(version, change)
+                break
+        if len(self._nearby_versions) >= self.max_cached_estimates:
+            self._nearby_versions = dict()
+        self._nearby_versions[locationKey] = (self._version, version)
+        return version
+
+    def _estimate_version(self, geoip: GeoIP, accuracy: PingAccuracy) -> tuple:
+        # changes whenever a cache entry an estimate of this accuracy for geoip depends on changes
+        cityKey, regionKey, countryKey, locationKey = self.cache_keys(geoip)
+        if cityKey in self._storage:
+            # city estimates only depend on the city
+            return (self._epoch, self._versions.get(cityKey, 0))
+        nearby = 0
+        if locationKey is not None:
+            nearby = self._nearby_version(locationKey, geoip.latitude, geoip.longitude)
+        if accuracy == PingAccuracy.Nearby:
+            return (self._epoch, 0, nearby)
+        # region and country estimates also depend on there being no nearby estimate
+        return (self._epoch, 0, nearby, self._versions.get(regionKey, 0), self._versions.get(countryKey, 0))
+
+    def estimate_version(self, geoip: GeoIP) -> tuple:
+        # changes whenever any cache entry the current estimate for geoip depends on changes
+        cached = self._estimates.get(self.cache_keys(geoip))
+        return self._estimate_version(geoip, cached[1].Accuracy if cached is not None else PingAccuracy.NA)
         
+    def _summarise(self, samples: list[list[float]], now: float) -> tuple[float, float, float, int]:
+        # (low, time decayed mean, high, count), so recent samples count for more than old ones
+        low = None
+        high = None
+        total = 0
+        total_weight = 0
+        half_life = self.decay_half_life_days * 86400
+        for ping, timestamp in samples:
+            if high is None or high < ping: high = ping
+            if low is None or low > ping: low = ping
+            weight = 0.5 ** (max(now - timestamp, 0) / half_life)
+            total += weight * ping
+            total_weight += weight
+        mean = total / total_weight if total_weight > 0 else -1
+        return low, mean, high, len(samples)
+
     def estimate_key(self, key:str) -> PingEstimate:
         estimate = PingEstimate()
         if key in self:
-            total = 0
-            estimate.Count = len(self._storage[key])
-            
-            for ping in self._storage[key]:
-                if estimate.High is None \
-                or estimate.High < ping:
-                    estimate.High = ping
-                if estimate.Low is None \
-                or estimate.Low > ping:
-                    estimate.Low = ping
-                total += ping
-            try:
-                estimate.Mean = total / estimate.Count
-            except:
-                estimate.Mean = -1
+            now = time.time()
+            estimate.Low, estimate.Mean, estimate.High, estimate.Count = self._summarise(self._storage[key], now)
+            self._last_used[key] = now
             
         return estimate
 
+    def estimate_location(self, latitude: float, longitude: float) -> PingCacheEstimate:
+        # a distance weighted average of the nearest places we have accurate pings for
+        cacheEntry = PingCacheEstimate()
+        if latitude is None or longitude is None: return cacheEntry
+        if self._spatial_index is None:
+            now = time.time()
+            self._spatial_index = KDTree([self._location_summary(key, now) for key in self._locations.keys()])
+        neighbours = [(distance, summary) for distance, summary in
+                      self._spatial_index.nearest(latitude, longitude, self.nearest_k)
+                      if distance <= self.nearest_max_distance_km]
+        if len(neighbours) == 0: return cacheEntry
+
+        total_weight = 0
+        weighted_ping = 0
+        weighted_distance = 0
+        estimate = PingEstimate()
+        estimate.Count = 0
+        for distance, (_, (low, mean, high, count)) in neighbours:
+            weight = 1 / (distance + self.nearest_distance_softening_km) ** 2
+            total_weight += weight
+            weighted_ping += weight * mean
+            weighted_distance += weight * distance
+            estimate.Count += count
+            if estimate.Low is None or estimate.Low > low: estimate.Low = low
+            if estimate.High is None or estimate.High < high: estimate.High = high
+        estimate.Mean = weighted_ping / total_weight
+        weighted_distance /= total_weight
+
+        # far away or thinly sampled neighbours make for a less confident estimate
+        cacheEntry.Confidence = exp(-weighted_distance * log(2) / self.nearest_confidence_distance_km) \
+                                * (1 - exp(-estimate.Count / 3))
+        if cacheEntry.Confidence < self.nearest_min_confidence: return cacheEntry
+        cacheEntry.Estimate = estimate
+        cacheEntry.Accuracy = PingAccuracy.Nearby
+        cacheEntry.Keys = [key for _, (key, _) in neighbours]
+        # every place that went into the estimate has been used, so isn't expired
+        self._mark_used(cacheEntry.Keys)
+        return cacheEntry
+
+    def _key_coordinates(self, key: str) -> tuple[float, float]:
+        # "country; lat,lon" -> (lat, lon)
+        latitude, longitude = [float(c) for c in key.split("; ")[-1].split(",")]
+        return latitude, longitude
+
+    def _location_summary(self, key: str, now: float) -> tuple[float, float, tuple[str, tuple[float, float, float, int]]]:
+        # "country; lat,lon" -> (lat, lon, (key, (low, mean, high, count)))
+        latitude, longitude = self._key_coordinates(key)
+        return latitude, longitude, (key, self._summarise(self._locations[key], now))
+
+    def _mark_used(self, keys: list[str]) -> None:
+        now = time.time()
+        for key in keys:
+            self._last_used[key] = now
+
+    def mark_estimate_used(self, geoip: GeoIP) -> None:
+        # for a caller that kept the cached estimate for geoip without asking for it again
+        cached = self._estimates.get(self.cache_keys(geoip))
+        if cached is not None:
+            self._mark_used(cached[1].Keys)
+
     def estimate_peer(self, peer:Peer) -> PingCacheEstimate:
+        if peer.geoip is None:
+            return PingCacheEstimate()
+        keys = self.cache_keys(peer.geoip)
+        cached = self._estimates.get(keys)
+        if cached is not None and cached[0] == self._estimate_version(peer.geoip, cached[1].Accuracy):
+            if cached[1].Accuracy != PingAccuracy.NA: self.hit_count += 1
+            # using a cached estimate is still a use of the keys it came from
+            self._mark_used(cached[1].Keys)
+            return cached[1]
+        cacheEntry = self._estimate_location(peer.geoip, keys)
+        if len(self._estimates) >= self.max_cached_estimates:
+            self._estimates = dict()
+        self._estimates[keys] = (self._estimate_version(peer.geoip, cacheEntry.Accuracy), cacheEntry)
+        return cacheEntry
+
+    def _estimate_location(self, geoip: GeoIP, keys: tuple[str, str, str, str]) -> PingCacheEstimate:
         # use the most accurate way we have to 
         cacheEntry = PingCacheEstimate()
         cacheEntry.Accuracy = PingAccuracy.NA
-        if peer.geoip is None:
-            return cacheEntry
-        cityKey = f"{peer.geoip.country}, {peer.geoip.region}, {peer.geoip.city}"
-        regionKey = f"{peer.geoip.country}, {peer.geoip.region}"
-        countryKey = f"{peer.geoip.country}"
+        cityKey, regionKey, countryKey, _ = keys
         if cityKey in self:
             cacheEntry.Estimate = self.estimate_key(cityKey)
             cacheEntry.Accuracy = PingAccuracy.City
+            cacheEntry.Keys = [cityKey]
             self.hit_count += 1
             return cacheEntry
+        # a nearby town we know about beats a region or country wide average
+        nearby = self.estimate_location(geoip.latitude, geoip.longitude)
+        if nearby.Accuracy != PingAccuracy.NA:
+            self.hit_count += 1
+            return nearby
         if regionKey in self:
             cacheEntry.Estimate = self.estimate_key(regionKey)
             cacheEntry.Accuracy = PingAccuracy.Region
+            cacheEntry.Keys = [regionKey]
             self.hit_count += 1
             return cacheEntry
         if countryKey in self:
             cacheEntry.Estimate = self.estimate_key(countryKey)
             cacheEntry.Accuracy = PingAccuracy.Country
+            cacheEntry.Keys = [countryKey]
             self.hit_count += 1
             return cacheEntry
         
         
         return cacheEntry
 
+    def to_dict(self) -> dict:
+        return {"version": 3, "pings": self._storage, "locations": self._locations, "last_used": self._last_used}
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def changes_since(self, version: int) -> dict:
+        # a to_dict() of only the keys changed after version, for merge()ing into another cache.
+        # using a key for an estimate isn't a change, so every key's last use is always included
+        changed = {key for key, v in self._versions.items() if v > version}
+        return {"version": 3,
+                "pings": {k: v for k, v in self._storage.items() if k in changed},
+                "locations": {k: v for k, v in self._locations.items() if k in changed},
+                "last_used": dict(self._last_used)}
+
+    def _from_dict(self, data: dict, default_timestamp: float = None) \
+            -> tuple[dict[str,list[list[float]]], dict[str,list[list[float]]], dict[str,float]]:
+        # version 1 cache files are just the pings dict, version 2 adds locations. neither has
+        # timestamps, so their samples are given default_timestamp (or now)
+        if default_timestamp is None: default_timestamp = time.time()
+        if not isinstance(data.get("version"), int):
+            data = {"version": 1, "pings": data}
+        storage = data.get("pings", dict())
+        locations = data.get("locations", dict())
+        last_used = data.get("last_used", dict())
+        if data["version"] < 3:
+            storage = {k: [[p, default_timestamp] for p in v] for k, v in storage.items()}
+            locations = {k: [[p, default_timestamp] for p in v] for k, v in locations.items()}
+        # keys we don't have a last use for were last used when their newest sample was added
+        for samples in [storage, locations]:
+            for key in samples.keys():
+                if key not in last_used and len(samples[key]) > 0:
+                    last_used[key] = max(s[1] for s in samples[key])
+        return storage, locations, last_used
+
     def persist_cache(self):
         self.remove_nones()
         if self.has_backing_cache():
             with open(self._fileName, 'w') as backingFile:
                 # If self.__fileName doesn't exist this will create it
-                json.dump(self._storage, backingFile, sort_keys=True, indent=4)
+                json.dump(self.to_dict(), backingFile, sort_keys=True, indent=4)
 
     def remove_nones(self):
-        self._storage = {key: self._storage[key] for key in self._storage.keys() \
+        storage = {key: self._storage[key] for key in self._storage.keys() \
                         if key is not None \
                         and len(self._storage[key]) > 0}
+        removed = [key for key in self._storage.keys() if key not in storage]
+        self._storage = storage
+        for key in removed:
+            self._changed(key)
+        locations = {key: self._locations[key] for key in self._locations.keys() \
+                        if key is not None \
+                        and len(self._locations[key]) > 0}
+        removed = [key for key in self._locations.keys() if key not in locations]
+        self._locations = locations
+        for key in removed:
+            self._changed(key, location=True)
+        self._last_used = {key: self._last_used[key] for key in self._last_used.keys() \
+                        if key in self._storage or key in self._locations}
 
     def restore_cache(self):
         if self.has_backing_cache():
             try:
                 with open(self._fileName, 'r') as backingFile:
-                    self._storage = json.load(backingFile)
-                    self.remove_nones()
+                    # older files don't have timestamps, so treat their samples as being as old as the file
+                    self.restore_dict(json.load(backingFile), os.fstat(backingFile.fileno()).st_mtime)
                     
             except FileNotFoundError:
                 # We didn't find the file
                 # TODO: error here properly?
                 pass
 
+    def restore_dict(self, data: dict, default_timestamp: float = None) -> None:
+        # replace the cache with a to_dict(), e.g. from the cache file or a snapshot
+        self._storage, self._locations, self._last_used = self._from_dict(data, default_timestamp)
+        self._reset_versions()
+        self.remove_nones()
+
+    def backing_cache_mtime(self) -> int:
+        # None if there's no cache file (yet)
+        if not self.has_backing_cache(): return None
+        try:
+            return os.stat(self._fileName).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
     def load_minimum_pings(self) -> None:
         try:
             with open("minimum_ping.json", 'r') as minPingFile:
@@ -158,15 +440,82 @@ class PingCache:
             for cacheKey in self._storage.keys():
                 if cacheKey.startswith(minPingKey):
                     current_cache = self._storage[cacheKey]
-                    self._storage[cacheKey] = [p for p in current_cache if p > minPingValue]
+                    self._storage[cacheKey] = [s for s in current_cache if s[0] > minPingValue]
+                    if len(self._storage[cacheKey]) != len(current_cache):
+                        self._changed(cacheKey)
+            for cacheKey in self._locations.keys():
+                if cacheKey.startswith(minPingKey):
+                    current_cache = self._locations[cacheKey]
+                    self._locations[cacheKey] = [s for s in current_cache if s[0] > minPingValue]
+                    if len(self._locations[cacheKey]) != len(current_cache):
+                        self._changed(cacheKey, location=True)
+        self.remove_nones()
+
+    def _upsert_sample(self, storage: dict[str,list[list[float]]], key: str, ping: float, timestamp: float) -> bool:
+        # returns True if the samples changed
+        if key not in storage:
+            storage[key] = []
+        samples = storage[key]
+        self._last_used[key] = max(self._last_used.get(key, 0), timestamp)
+        for sample in samples:
+            if sample[0] == ping:
+                # we've seen this ping before, it's just more recent now
+                if sample[1] >= timestamp: return False
+                sample[1] = timestamp
+                return True
+        samples.append([ping, timestamp])
+        if len(samples) > self.max_samples_per_key:
+            # evict the oldest sample
+            samples.remove(min(samples, key=lambda s: s[1]))
+        return True
 
-    def upsert(self,key:str,ping:float) -> None:
+    def upsert(self,key:str,ping:float,timestamp:float=None) -> None:
         if key is not None:
             if isinstance(ping,float):
-                if key not in self:
-                    self._storage[key] = []
-                if ping not in self._storage[key]:
-                    self._storage[key].append(ping)
+                if timestamp is None: timestamp = time.time()
+                if self._upsert_sample(self._storage, key, ping, timestamp):
+                    self._changed(key)
+
+    def upsert_location(self, key:str, ping:float, timestamp:float=None) -> None:
+        if key is not None:
+            if isinstance(ping,float):
+                if timestamp is None: timestamp = time.time()
+                if self._upsert_sample(self._locations, key, ping, timestamp):
+                    self._changed(key, location=True)
+
+    def compact(self, force: bool = False) -> None:
+        # drops samples and keys we no longer want, so the cache stays bounded.
+        # run from maintenance, at most every compaction_interval_seconds unless forced
+        now = time.time()
+        if not force and now - self._last_compaction < self.compaction_interval_seconds: return
+        self._last_compaction = now
+        oldest_sample = now - self.max_sample_age_days * 86400
+        oldest_use = now - self.key_expiry_days * 86400
+        for storage in [self._storage, self._locations]:
+            for key in list(storage.keys()):
+                if self._last_used.get(key, 0) < oldest_use:
+                    del storage[key]
+                    self._changed(key, location=storage is self._locations)
+                    continue
+                samples = [s for s in storage[key] if s[1] >= oldest_sample]
+                samples.sort(key=lambda s: s[1])
+                samples = samples[-self.max_samples_per_key:]
+                if len(samples) != len(storage[key]):
+                    self._changed(key, location=storage is self._locations)
+                storage[key] = samples
+        self.remove_nones()
+
+    def merge(self, cache: dict) -> None:
+        # fold another cache's entries (e.g. from a shard worker's to_dict()) into this one
+        storage, locations, last_used = self._from_dict(cache)
+        for key, samples in storage.items():
+            for ping, timestamp in samples:
+                self.upsert(key, float(ping), timestamp)
+        for key, samples in locations.items():
+            for ping, timestamp in samples:
+                self.upsert_location(key, float(ping), timestamp)
+        for key, timestamp in last_used.items():
+            self._last_used[key] = max(self._last_used.get(key, 0), timestamp)
 
     def __contains__(self, key:str):
         return key in self._storage.keys()
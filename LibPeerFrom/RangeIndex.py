@@ -0,0 +1,138 @@
+from ipaddress import ip_address, ip_network, summarize_address_range, IPv4Address, IPv6Address
+from bisect import bisect_right
+from typing import Iterable
+
+import json
+import os
+
+
+class RangeIndex:
+    # A set of ip ranges (and single addresses) that answers "is this address in any of them"
+    # with one set lookup or one binary search, rather than a scan over every network.
+    # Ranges can come from code, or from provider range files on disk, which are reloaded
+    # when they change. Supported files are any json that contains cidr strings (AWS's
+    # ip-ranges.json, GCP's cloud.json, Azure's service tags...) or plain text with one cidr per line.
+    # at most this many single addresses are remembered, the oldest are forgotten first
+    MAX_ADDRESSES = 4096
+
+    _paths: list[str]
+    _mtimes: dict[str, float]
+    _static: list[str]
+    _starts: dict[int, list[int]]
+    _ends: dict[int, list[int]]
+    _addresses: dict[str, None]     # in insertion order, so the first is the oldest
+
+    def __init__(self, paths: Iterable[str] = None, networks: Iterable[str] = None):
+        self._paths = [p for p in (paths or []) if p != ""]
+        self._mtimes = dict()
+        self._static = list(networks or [])
+        self._starts = {4: [], 6: []}
+        self._ends = {4: [], 6: []}
+        self._addresses = dict()
+        self.load()
+
+    def load(self) -> None:
+        networks = list(self._static)
+        for path in self._paths:
+            try:
+                self._mtimes[path] = os.stat(path).st_mtime
+                networks += self._read_networks(path)
+            except FileNotFoundError:
+                print("Server range file not found:", path)
+        self._build(networks)
+
+    def reload_if_changed(self) -> bool:
+        changed = False
+        for path in self._paths:
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self._mtimes.get(path):
+                changed = True
+        if changed:
+            self.load()
+        return changed
+
+    @staticmethod
+    def _read_networks(path: str) -> list[str]:
+        with open(path, 'r') as rangeFile:
+            text = rangeFile.read()
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            return [line.split("#")[0].strip() for line in text.splitlines() if line.split("#")[0].strip() != ""]
+        networks = []
+        pending = [data]
+        while len(pending) > 0:
+            item = pending.pop()
+            if isinstance(item, dict): pending += item.values()
+            elif isinstance(item, list): pending += item
+            elif isinstance(item, str) and "/" in item: networks.append(item)
+        return networks
+
+    def _build(self, networks: list[str]) -> None:
+        ranges = {4: [], 6: []}
+        for n in networks:
+            try:
+                net = ip_network(n, strict=False)
+            except ValueError:
+                continue
+            ranges[net.version].append((int(net.network_address), int(net.broadcast_address)))
+        for version, version_ranges in ranges.items():
+            # merge overlapping ranges, so each address falls in at most one
+            version_ranges.sort()
+            starts, ends = [], []
+            for start, end in version_ranges:
+                if len(ends) > 0 and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._starts[version] = starts
+            self._ends[version] = ends
+
+    def add_address(self, address: str) -> None:
+        # remember a single address, e.g. one we've rejected after a geoip lookup. one we forget
+        # only costs another lookup (and the geoip cache usually saves us that)
+        self._addresses.pop(address, None)
+        self._addresses[address] = None
+        while len(self._addresses) > self.MAX_ADDRESSES:
+            del self._addresses[next(iter(self._addresses))]
+
+    def contains_many(self, addresses):
+        # vectorised __contains__ for a numpy array of ipv4 addresses as ints, returns a bool array.
+        # numpy is only needed for batches, so it's only imported here
+        import numpy as np
+        addresses = np.asarray(addresses, dtype=np.int64)
+        starts = np.asarray(self._starts[4], dtype=np.int64)
+        ends = np.asarray(self._ends[4], dtype=np.int64)
+        i = np.searchsorted(starts, addresses, side="right") - 1
+        found = (i >= 0) & (addresses <= ends[np.maximum(i, 0)]) if len(starts) > 0 \
+                else np.zeros(len(addresses), dtype=bool)
+        memo = [int(ip_address(a)) for a in self._addresses if ip_address(a).version == 4]
+        if len(memo) > 0:
+            found |= np.isin(addresses, memo)
+        return found
+
+    def networks(self, version: int = 4) -> list[str]:
+        # the merged ranges (and remembered addresses) as the fewest cidrs that cover them, e.g. for a bpf filter
+        address_type = IPv4Address if version == 4 else IPv6Address
+        networks = []
+        for start, end in zip(self._starts[version], self._ends[version]):
+            networks += [str(n) for n in summarize_address_range(address_type(start), address_type(end))]
+        for address in sorted(self._addresses):
+            ip = ip_address(address)
+            if ip.version == version:
+                networks.append(f"{ip}/{ip.max_prefixlen}")
+        return networks
+
+    def __contains__(self, address: str) -> bool:
+        if address in self._addresses: return True
+        ip = ip_address(address)
+        starts = self._starts[ip.version]
+        i = bisect_right(starts, int(ip)) - 1
+        return i >= 0 and int(ip) <= self._ends[ip.version][i]
+
+    def __len__(self) -> int:
+        return len(self._starts[4]) + len(self._starts[6]) + len(self._addresses)
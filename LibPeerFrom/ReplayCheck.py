@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# Replays a pcap file through both ingest paths, Peers.add_peer_from_packet one packet at a time
+# and Peers.add_packets in batches, and checks they leave identical peer state: the same peers,
+# counts, timestamps, rate history and resend detection state. Lookups go to an in process
+# FakeIpinfo, so the check runs offline and every run sees the same locations.
+# With --workers it instead replays the capture with maintenance, as the single process mode runs it,
+# and through ShardedIngest with each worker count, and checks the workers end up with the same
+# peers, counts and accurate pings. Pings go to a FakePinger that answers (or doesn't) the same way
+# every time, so both see the same pings.
+#
+#   python3 -m LibPeerFrom.ReplayCheck --address=10.0.0.50 --batch_size=256,4096 capture.pcap
+#   python3 -m LibPeerFrom.ReplayCheck --address=10.0.0.50 --workers=1,4 capture.pcap
+import sys
+import time
+import getopt
+from typing import Union
+from collections import Counter
+from datetime import datetime
+
+from LibPeerFrom import Helpers
+from LibPeerFrom.Peer import Peer
+from LibPeerFrom.Peers import Peers
+from LibPeerFrom.PcapReader import PcapReader
+from LibPeerFrom.FakeIpinfo import FakeIpinfo
+from LibPeerFrom.FakePinger import FakePinger, PingProfile
+from LibPeerFrom.ShardedIngest import ShardedIngest
+
+
+def peer_state(peer: Peer) -> dict:
+    # everything ingest sets on a peer
+    return {"packets_sent": peer.packets_sent, "packets_received": peer.packets_received,
+            "packets_resent": peer.packets_resent, "times_seen": peer.times_seen,
+            "first_seen": peer.first_seen, "last_seen": peer.last_seen,
+            "ping": peer.ping, "ping_type": peer.ping_type, "geoip": str(peer.geoip),
+            "ping_history": (peer.ping_history.times(), peer.ping_history.values()),
+            "packet_rate_history": (peer.packet_rate_history.times(), peer.packet_rate_history.values()),
+            "resend_rate_history": (peer.resend_rate_history.times(), peer.resend_rate_history.values()),
+            "interval": (peer._interval_start, peer._interval_packets, peer._interval_sent, peer._interval_resent),
+            "packet_data_sent": sorted(peer.packet_data_sent)}
+
+
+def replay_packets(path: str, local_ip: str) -> tuple[Peers, float]:
+    Helpers.GEOIP_CACHE.clear()
+    peers = Peers(local_ip)
+    with open(path, 'rb') as pcap:
+        records = list(PcapReader(pcap).records())
+    started = time.perf_counter()
+    for record in records:
+        peers.add_peer_from_packet(record)
+    return peers, time.perf_counter() - started
+
+
+def replay_batches(path: str, local_ip: str, batch_size: int) -> tuple[Peers, float]:
+    Helpers.GEOIP_CACHE.clear()
+    peers = Peers(local_ip)
+    with open(path, 'rb') as pcap:
+        batches = list(PcapReader(pcap).batches(batch_size))
+    started = time.perf_counter()
+    for batch in batches:
+        peers.add_packets(batch)
+    return peers, time.perf_counter() - started
+
+
+def replay_capture(path: str, local_ip: str) -> tuple[Peers, float]:
+    # the single process mode: one packet at a time, with maintenance as run_capture runs it
+    Helpers.GEOIP_CACHE.clear()
+    peers = Peers(local_ip)
+    with open(path, 'rb') as pcap:
+        records = list(PcapReader(pcap).records())
+    started = time.perf_counter()
+    last_maintenance_time = datetime.now()
+    for record in records:
+        current_time = datetime.now()
+        added = peers.add_peer_from_packet(record) is not None
+        if added or peers.maintenance_due(last_maintenance_time, record.sniff_time):
+            peers.run_maintenance(record.sniff_time, persist=False)
+            last_maintenance_time = current_time
+    return peers, time.perf_counter() - started
+
+
+def replay_sharded(path: str, local_ip: str, workers: int) -> tuple[Peers, float, Union[None, str]]:
+    # the whole capture, from reading the file to the merged view, as --workers runs it
+    Helpers.GEOIP_CACHE.clear()
+    with open(path, 'rb') as pcap:
+        started = time.perf_counter()
+        ingest = ShardedIngest(pcap, local_ip, workers)
+        ingest.start()
+        try:
+            while not ingest.finished():
+                ingest.poll()
+        finally:
+            ingest.close()
+    return ingest.view, time.perf_counter() - started, ingest.error
+
+
+def sharded_state(peer: Peer) -> dict:
+    # what the merged view shows. estimates can differ, as other workers' pings reach a worker a
+    # maintenance later, but accurate pings are measured to the peer itself. the view sorts every
+    # time a worker reports, which truncates last_seen, so times are compared to the second
+    state = {"packets_sent": peer.packets_sent, "packets_received": peer.packets_received,
+             "packets_resent": peer.packets_resent, "times_seen": peer.times_seen,
+             "first_seen": peer.first_seen.replace(microsecond=0),
+             "last_seen": peer.last_seen.replace(microsecond=0), "geoip": str(peer.geoip),
+             "accurate": peer.has_accurate_ping()}
+    if peer.has_accurate_ping():
+        state["ping"] = peer.ping
+    return state
+
+
+def differences(expected: Peers, actual: Peers, state=peer_state) -> list[str]:
+    # human readable differences between two sets of peers, empty if they're identical
+    found = []
+    expected_state = {p.remote_ip: state(p) for p in expected}
+    actual_state = {p.remote_ip: state(p) for p in actual}
+    for ip in sorted(expected_state.keys() - actual_state.keys()):
+        found.append(f"{ip}: missing")
+    for ip in sorted(actual_state.keys() - expected_state.keys()):
+        found.append(f"{ip}: unexpected")
+    for ip in sorted(expected_state.keys() & actual_state.keys()):
+        for field, value in expected_state[ip].items():
+            if actual_state[ip].get(field) != value:
+                found.append(f"{ip}: {field} differs")
+    return found
+
+
+def ping_types(peers: Peers) -> str:
+    return ", ".join(f"{count} {name}" for name, count in sorted(Counter(p.ping_type.name for p in peers).items()))
+
+
+def check_batches(path: str, local_ip: str, batch_sizes: list[int]) -> bool:
+    expected, seconds = replay_packets(path, local_ip)
+    print(f"per packet:          {len(expected)} peers in {seconds:.3f}s")
+    failed = False
+    for batch_size in batch_sizes:
+        actual, seconds = replay_batches(path, local_ip, batch_size)
+        found = differences(expected, actual)
+        print(f"batches of {batch_size:<8} {len(actual)} peers in {seconds:.3f}s: "
+              f"{'identical' if len(found) == 0 else f'{len(found)} differences'}")
+        for difference in found[:20]:
+            print("   ", difference)
+        failed = failed or len(found) > 0
+    return not failed
+
+
+def check_workers(path: str, local_ip: str, worker_counts: list[int]) -> bool:
+    # pings go unanswered for the addresses whose latency is over the timeout, so there are
+    # estimates as well as accurate pings, and no pings are lost at random
+    Helpers.PINGER = FakePinger(default=PingProfile(latency_ms=80), spread_ms=1500, sleep=False)
+    expected, seconds = replay_capture(path, local_ip)
+    print(f"single process:      {len(expected)} peers in {seconds:.3f}s ({ping_types(expected)})")
+    failed = False
+    for workers in worker_counts:
+        actual, seconds, error = replay_sharded(path, local_ip, workers)
+        found = differences(expected, actual, sharded_state)
+        if error is not None:
+            found.insert(0, error)
+        print(f"{workers:>2} workers:          {len(actual)} peers in {seconds:.3f}s ({ping_types(actual)}): "
+              f"{'identical' if len(found) == 0 else f'{len(found)} differences'}")
+        for difference in found[:20]:
+            print("   ", difference)
+        failed = failed or len(found) > 0
+    return not failed
+
+
+def usage():
+    print("ReplayCheck.py: check batched and sharded ingest leave the same peer state as per packet ingest")
+    print("usage: python3 -m LibPeerFrom.ReplayCheck --address=<local ip> [options] file.pcap")
+    print("options:")
+    print(" -a, --address (required):   ip address of the host the capture was taken for")
+    print(" --batch_size:               comma separated batch sizes to check. default is 256,4096")
+    print(" --resend_prefix_bytes:      bytes of each payload used to detect resends. default is 0 (all)")
+    print(" --workers:                  comma separated worker counts to check against the single process")
+    print("                             mode, with maintenance and pings, instead of the batch sizes")
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ha:", ["help", "address=", "batch_size=", "resend_prefix_bytes=",
+                                                       "workers="])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        exit(2)
+    local_ip = None
+    batch_sizes = [256, 4096]
+    worker_counts = []
+    for o, a in opts:
+        if o in ["--help", "-h"]:
+            usage()
+            exit()
+        elif o in ["--address", "-a"]:
+            local_ip = a
+        elif o in ["--batch_size"]:
+            batch_sizes = [int(n) for n in a.split(",")]
+        elif o in ["--resend_prefix_bytes"]:
+            Helpers.RESEND_PREFIX_BYTES = int(a)
+        elif o in ["--workers"]:
+            worker_counts = [int(n) for n in a.split(",")]
+    if local_ip is None or len(args) != 1:
+        usage()
+        exit(2)
+
+    server = FakeIpinfo().start()
+    Helpers.IPINFO_URL = server.url
+    try:
+        if len(worker_counts) > 0:
+            passed = check_workers(args[0], local_ip, worker_counts)
+        else:
+            passed = check_batches(args[0], local_ip, batch_sizes)
+    finally:
+        server.close()
+    exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
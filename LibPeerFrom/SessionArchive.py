@@ -0,0 +1,203 @@
+from LibPeerFrom.Peer import Peer
+from LibPeerFrom.Helpers import PingType
+from datetime import datetime, timedelta
+from typing import Union
+
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+
+class SessionRecord:
+    ip: str
+    country: str
+    region: str
+    city: str
+    org: str
+    first_seen: datetime
+    last_seen: datetime
+    packets_sent: int
+    packets_received: int
+    packets_resent: int
+    resend_ratio: float
+    ping_type: str
+    ping: float
+
+    def __init__(self, peer: Peer):
+        self.ip = peer.remote_ip
+        self.country = ""
+        self.region = ""
+        self.city = ""
+        self.org = ""
+        if peer.geoip is not None:
+            self.country = peer.geoip.country or ""
+            self.region = peer.geoip.region or ""
+            self.city = peer.geoip.city or ""
+            self.org = peer.geoip.org or ""
+        self.first_seen = peer.first_seen
+        self.last_seen = peer.last_seen
+        self.packets_sent = peer.packets_sent
+        self.packets_received = peer.packets_received
+        self.packets_resent = peer.packets_resent
+        self.resend_ratio = peer.packets_resent / peer.packets_sent if peer.packets_sent > 0 else 0
+        self.ping_type = peer.ping_type.name
+        self.ping = peer.ping
+
+    def as_row(self) -> tuple:
+        return (self.ip, self.country, self.region, self.city, self.org,
+                self.first_seen.timestamp(), self.last_seen.timestamp(),
+                self.packets_sent, self.packets_received, self.packets_resent, self.resend_ratio,
+                self.ping_type, self.ping)
+
+
+class SessionArchive:
+    # An append only sqlite archive of finished peer sessions.
+    # Writes are queued and committed in batches by a background thread, so recording a
+    # session never waits on the disk. Queries use their own connection.
+
+    _SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " id INTEGER PRIMARY KEY,"
+        " ip TEXT NOT NULL,"
+        " country TEXT NOT NULL, region TEXT NOT NULL, city TEXT NOT NULL, org TEXT NOT NULL,"
+        " first_seen REAL NOT NULL, last_seen REAL NOT NULL,"
+        " packets_sent INTEGER NOT NULL, packets_received INTEGER NOT NULL, packets_resent INTEGER NOT NULL,"
+        " resend_ratio REAL NOT NULL,"
+        " ping_type TEXT NOT NULL, ping REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS sessions_ip ON sessions (ip, last_seen)",
+        "CREATE INDEX IF NOT EXISTS sessions_location ON sessions (country, region, city, last_seen)",
+        "CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)",
+    ]
+    _INSERT = "INSERT INTO sessions (ip, country, region, city, org, first_seen, last_seen, " \
+              "packets_sent, packets_received, packets_resent, resend_ratio, ping_type, ping) " \
+              "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)"
+
+    _fileName: str
+    retention: Union[None, timedelta]
+    batch_size: int
+    flush_interval: float
+
+    def __init__(self, fileName: str, retention_days: int = 0, batch_size: int = 100, flush_interval: float = 5):
+        if fileName == "": raise ValueError("No archive file specified")
+        self._fileName = fileName
+        self.retention = timedelta(days=retention_days) if retention_days > 0 else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._last_compaction = None
+        self._reader = self._connect()
+        with self._reader as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            for statement in self._SCHEMA:
+                db.execute(statement)
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="SessionArchive", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        # several shard workers may share one archive, so wait on each other's locks
+        return sqlite3.connect(self._fileName, timeout=30)
+
+    def record(self, peer: Peer) -> None:
+        self._queue.put(SessionRecord(peer))
+
+    def _write_loop(self) -> None:
+        db = self._connect()
+        running = True
+        while running:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            if len(batch) > 0:
+                with db:
+                    db.executemany(self._INSERT, [r.as_row() for r in batch])
+                for _ in batch: self._queue.task_done()
+            self._maintain(db)
+        db.close()
+
+    def _maintain(self, db: sqlite3.Connection) -> None:
+        # retention and compaction run on the writer thread, at most once a day
+        if self.retention is None: return
+        if self._last_compaction is not None \
+        and time.monotonic() - self._last_compaction < timedelta(days=1).total_seconds():
+            return
+        self._last_compaction = time.monotonic()
+        self.apply_retention(db)
+        self.compact(db)
+
+    def apply_retention(self, db: sqlite3.Connection = None) -> int:
+        if self.retention is None: return 0
+        cutoff = (datetime.now() - self.retention).timestamp()
+        db = db or self._reader
+        with db:
+            return db.execute("DELETE FROM sessions WHERE last_seen < ?", (cutoff,)).rowcount
+
+    def compact(self, db: sqlite3.Connection = None) -> None:
+        db = db or self._reader
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.execute("VACUUM")
+        db.execute("PRAGMA optimize")
+
+    def flush(self) -> None:
+        # wait until every recorded session has been written
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._reader.close()
+
+    def times_seen(self, ip: str) -> int:
+        # how many sessions we've had with this ip, 0 if we've never met
+        return self._reader.execute("SELECT COUNT(*) FROM sessions WHERE ip = ?", (ip,)).fetchone()[0]
+
+    def seen_before(self, ip: str) -> bool:
+        return self._reader.execute("SELECT 1 FROM sessions WHERE ip = ? LIMIT 1", (ip,)).fetchone() is not None
+
+    def average_ping(self, country: str, region: str = None, city: str = None,
+                     since: datetime = None, accurate_only: bool = False) -> tuple[Union[None, float], int]:
+        # returns (mean ping, number of sessions) for a location, ignoring sessions without a ping
+        query = "SELECT AVG(ping), COUNT(*) FROM sessions WHERE country = ?"
+        args = [country]
+        if region is not None:
+            query += " AND region = ?"
+            args.append(region)
+            if city is not None:
+                query += " AND city = ?"
+                args.append(city)
+        if since is not None:
+            query += " AND last_seen >= ?"
+            args.append(since.timestamp())
+        if accurate_only:
+            query += " AND ping_type = ?"
+            args.append(PingType.Accurate.name)
+        query += " AND ping > 0"
+        mean, count = self._reader.execute(query, args).fetchone()
+        return mean, count
+
+    def top_repeat_peers(self, limit: int = 10, since: datetime = None) -> list[tuple[str, int, datetime]]:
+        # returns (ip, session count, last seen) for the peers we've met most often
+        query = "SELECT ip, COUNT(*) AS sessions, MAX(last_seen) FROM sessions"
+        args = []
+        if since is not None:
+            query += " WHERE last_seen >= ?"
+            args.append(since.timestamp())
+        query += " GROUP BY ip HAVING sessions > 1 ORDER BY sessions DESC, MAX(last_seen) DESC LIMIT ?"
+        args.append(limit)
+        return [(ip, count, datetime.fromtimestamp(last_seen))
+                for ip, count, last_seen in self._reader.execute(query, args).fetchall()]
+
+    def __len__(self) -> int:
+        return self._reader.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
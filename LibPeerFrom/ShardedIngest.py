@@ -0,0 +1,385 @@
+import os
+import copy
+import time
+import queue
+import signal
+import struct
+import zlib
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from datetime import datetime
+from socket import inet_ntoa, inet_aton
+from typing import Union
+
+from LibPeerFrom.Peer import Peer
+from LibPeerFrom.Peers import Peers
+from LibPeerFrom.PcapReader import PcapReader, PacketRecord, payload_digest
+
+# Sharded ingest splits the capture across processes:
+#   reader process -> one ShmRing per shard -> shard worker processes (one Peers each)
+#   shard workers -> results queue -> ShardedPeers, a merged view living in the main process
+# Each remote address always hashes to the same shard, so each worker sees every packet
+# for its peers and runs the same Peers logic as the single process mode.
+
+
+class ShmRing:
+    # single producer, single consumer ring of fixed size packet slots in shared memory.
+    # the header holds the head (next slot to write) and tail (next slot to read) counters,
+    # a closed flag set by the producer once the stream has ended, and a reader closed flag
+    # set by the consumer once it has stopped reading.
+    HEADER_SIZE = 64
+    SLOT_SIZE = 32
+    _slot = struct.Struct("<dIIHH8s")  # timestamp, src, dst, udp length, flags, payload digest
+    _counter = struct.Struct("<Q")
+    FLAG_HAS_DATA = 1
+
+    capacity: int
+    _shm: SharedMemory
+    _owner_pid: int
+
+    def __init__(self, capacity: int = 65536):
+        self.capacity = capacity
+        # the process that created the ring, and that the producer and consumer are forked from
+        self._owner_pid = os.getpid()
+        self._shm = SharedMemory(create=True, size=self.HEADER_SIZE + capacity * self.SLOT_SIZE)
+        self._shm.buf[:self.HEADER_SIZE] = bytes(self.HEADER_SIZE)
+
+    def _get(self, offset: int) -> int:
+        return self._counter.unpack_from(self._shm.buf, offset)[0]
+
+    def _set(self, offset: int, value: int) -> None:
+        self._counter.pack_into(self._shm.buf, offset, value)
+
+    @property
+    def closed(self) -> bool:
+        return self._get(16) != 0
+
+    def close_writer(self) -> None:
+        self._set(16, 1)
+
+    @property
+    def reader_closed(self) -> bool:
+        return self._get(24) != 0
+
+    def close_reader(self) -> None:
+        # the consumer has stopped (or crashed), so nothing will ever make room in the ring
+        self._set(24, 1)
+
+    def owner_gone(self) -> bool:
+        # True in a forked producer or consumer once the process that created the ring has died
+        return os.getpid() != self._owner_pid and os.getppid() != self._owner_pid
+
+    def __len__(self) -> int:
+        return self._get(0) - self._get(8)
+
+    # returns False, dropping the packet, if the consumer has gone away
+    def push(self, timestamp: float, src: int, dst: int, length: int, payload: bytes) -> bool:
+        head = self._get(0)
+        # the ring is full, wait for the worker to catch up
+        while head - self._get(8) >= self.capacity:
+            if self.reader_closed or self.owner_gone():
+                return False
+            time.sleep(0.0005)
+        flags = self.FLAG_HAS_DATA if len(payload) > 0 else 0
+        digest = bytes.fromhex(payload_digest(payload)) if flags else bytes(8)
+        self._slot.pack_into(self._shm.buf, self.HEADER_SIZE + (head % self.capacity) * self.SLOT_SIZE,
+                             timestamp, src, dst, length, flags, digest)
+        # publish the slot only once it has been written
+        self._set(0, head + 1)
+        return True
+
+    def pop_many(self, limit: int = 1024) -> list[tuple[float, int, int, int, int, bytes]]:
+        tail = self._get(8)
+        available = min(self._get(0) - tail, limit)
+        slots = [self._slot.unpack_from(self._shm.buf, self.HEADER_SIZE + ((tail + i) % self.capacity) * self.SLOT_SIZE)
+                 for i in range(available)]
+        if available > 0:
+            self._set(8, tail + available)
+        return slots
+
+    def release(self, unlink: bool = False) -> None:
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+def shard_for(remote: int, shard_count: int) -> int:
+    return zlib.crc32(remote.to_bytes(4, "big")) % shard_count
+
+
+def _reader_process(source_fd: int, rings: list[ShmRing], local_ip: str) -> None:
+    # ctrl+c reaches every process in the group, but the reader is stopped by ShardedIngest.close
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    local = int.from_bytes(inet_aton(local_ip), "big")
+    try:
+        with os.fdopen(source_fd, "rb") as source:
+            for timestamp, src, dst, length, payload in PcapReader(source):
+                if src == local: remote = dst
+                elif dst == local: remote = src
+                else: continue  # not to or from us, the single process mode can't use these either
+                ring = rings[shard_for(remote, len(rings))]
+                if not ring.push(timestamp, src, dst, length, payload) and ring.owner_gone():
+                    # the main process has died, so there's no one left to read for
+                    break
+    finally:
+        for ring in rings:
+            ring.close_writer()
+
+
+def _snapshot(peers: Peers) -> list[Peer]:
+    # the merged view only displays peers, so don't ship the resend detection state
+    snapshot = []
+    for p in peers:
+        c = copy.copy(p)
+        c.packet_data_sent = set()
+        snapshot.append(c)
+    return snapshot
+
+
+def _apply_cache_updates(peers: Peers, control) -> None:
+    # merges what the other shards have learned (via the main process) into this shard's cache,
+    # so its estimates can use pings measured to peers in other shards
+    while True:
+        try:
+            cache_storage = control.get_nowait()
+        except queue.Empty:
+            return
+        peers.ping_cache.merge(cache_storage)
+
+
+def _shard_process(shard: int, ring: ShmRing, results, control, local_ip: str, sortmode: str, sortorder: str,
+                   cache_path: str, archive_path: str, archive_retention_days: int,
+                   server_range_files: list[str]) -> None:
+    # ctrl+c reaches every process in the group, but the workers are stopped by ShardedIngest.close
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # every shard appends its own finished sessions to the shared archive, but only the first
+    # applies retention and compacts it
+    peers = Peers(local_ip, sortmode, sortorder, cache_path, archive_path,
+                  archive_retention_days if shard == 0 else 0, server_range_files)
+    try:
+        _shard_loop(shard, ring, results, control, peers)
+    finally:
+        # if we've crashed, don't leave the reader waiting for room in the ring
+        ring.close_reader()
+        # worker processes exit without running atexit handlers, so write any queued sessions now
+        if peers.session_archive is not None:
+            peers.session_archive.close()
+
+
+def _shard_loop(shard: int, ring: ShmRing, results, control, peers: Peers) -> None:
+    peers.restore_cache()
+    # the cache is sent to the main process as changes since the last send
+    sent_version = peers.ping_cache.version
+    last_maintenance_time = datetime.now()
+    last_snapshot_time = None
+    sniff_time = None
+    while True:
+        slots = ring.pop_many()
+        if len(slots) == 0:
+            if ring.closed and len(ring) == 0: break
+            if ring.owner_gone(): break
+            time.sleep(0.001)
+            continue
+
+        should_send = False
+        ran_maintenance = False
+        cache_storage = None
+        for timestamp, src, dst, length, flags, digest in slots:
+            sniff_time = datetime.fromtimestamp(timestamp)
+            packet = PacketRecord(inet_ntoa(src.to_bytes(4, "big")), inet_ntoa(dst.to_bytes(4, "big")),
+                                  sniff_time, length, digest.hex() if flags & ShmRing.FLAG_HAS_DATA else "")
+            # as in the single process mode, run maintenance as soon as we add a peer
+            added = peers.add_peer_from_packet(packet) is not None
+            if added or peers.maintenance_due(last_maintenance_time, sniff_time):
+                _apply_cache_updates(peers, control)
+                # the main process merges every shard's cache and persists it
+                peers.run_maintenance(sniff_time, persist=False)
+                peers.ping_cache.remove_nones()
+                last_maintenance_time = datetime.now()
+                ran_maintenance = True
+                should_send = True
+
+        if ran_maintenance:
+            cache_storage = peers.ping_cache.changes_since(sent_version)
+            sent_version = peers.ping_cache.version
+
+        if last_snapshot_time is None or (sniff_time - last_snapshot_time).total_seconds() >= 1:
+            should_send = True
+        if should_send:
+            results.put(("snapshot", shard, _snapshot(peers), sniff_time, last_maintenance_time, cache_storage))
+            last_snapshot_time = sniff_time
+
+    results.put(("snapshot", shard, _snapshot(peers), sniff_time, last_maintenance_time,
+                 peers.ping_cache.changes_since(sent_version)))
+    results.put(("done", shard))
+
+
+class ShardedPeers(Peers):
+    # The merged, read only view of every shard's peers. Behaves like Peers for display
+    # purposes (to_dict, iteration, printing and the html view).
+    _shards: list[list[Peer]]
+    last_packet_time: Union[None, datetime]
+    last_maintenance_time: datetime
+
+    def __init__(self, local_ip, shard_count: int, sortmode="last_seen", sortorder="descending",
+                 cacheFileName: str = "", friendlyNameFileName: str = ""):
+        # names are applied here rather than in the shards, so only one process writes the file
+        super().__init__(local_ip, sortmode, sortorder, cacheFileName, friendlyNameFileName=friendlyNameFileName)
+        self._shards = [[] for _ in range(shard_count)]
+        self.last_packet_time = None
+        self.last_maintenance_time = datetime.now()
+
+    def merge_shard(self, shard: int, shard_peers: list[Peer], last_packet_time: datetime,
+                    last_maintenance_time: datetime, cache_storage: dict = None) -> None:
+        for p in shard_peers:
+            self.name_peer(p)
+        self._shards[shard] = shard_peers
+        self._storage = [p for s in self._shards for p in s]
+        self._index = {p.remote_ip for p in self._storage}
+        self.sort_peers()
+        if last_packet_time is not None \
+        and (self.last_packet_time is None or last_packet_time > self.last_packet_time):
+            self.last_packet_time = last_packet_time
+        if last_maintenance_time > self.last_maintenance_time:
+            self.last_maintenance_time = last_maintenance_time
+        if cache_storage is not None:
+            self.ping_cache.merge(cache_storage)
+            self.persist_cache()
+
+
+class ShardedIngest:
+    # Owns the reader and shard worker processes, and the merged view they feed.
+    # Each shard's cache changes are merged here, and sent on to every shard before its next
+    # maintenance, so a ping measured in one shard feeds estimates in the others. Unlike the
+    # single process mode, other shards only see it from their next maintenance (up to 20
+    # seconds later), not the one it was measured in.
+    shard_count: int
+    view: ShardedPeers
+    error: Union[None, str]     # why we stopped early, if a process failed
+    _rings: list[ShmRing]
+    _controls: list[multiprocessing.Queue]
+    _sent_versions: list[int]
+    _processes: list[multiprocessing.Process]
+    _reader: Union[None, multiprocessing.Process]
+    _done: set[int]
+
+    def __init__(self, source, local_ip: str, shard_count: int, sortmode="last_seen", sortorder="descending",
+                 cache_path: str = "", archive_path: str = "", archive_retention_days: int = 0,
+                 server_range_files: list[str] = None, friendlyname_file_path: str = "",
+                 ring_capacity: int = 65536):
+        if shard_count < 1: raise ValueError("Invalid shard count specified")
+        # fork, so that the workers inherit the shared memory, the capture fd and module globals
+        # such as the ipinfo token
+        self._context = multiprocessing.get_context("fork")
+        self.shard_count = shard_count
+        self.view = ShardedPeers(local_ip, shard_count, sortmode, sortorder, cache_path, friendlyname_file_path)
+        self.view.restore_cache()
+        self._source = source
+        self._local_ip = local_ip
+        self._sortmode = sortmode
+        self._sortorder = sortorder
+        self._cache_path = cache_path
+        self._archive_path = archive_path
+        self._archive_retention_days = archive_retention_days
+        self._server_range_files = server_range_files
+        self._rings = [ShmRing(ring_capacity) for _ in range(shard_count)]
+        self._results = self._context.Queue()
+        # merged cache changes, main process -> each shard
+        self._controls = [self._context.Queue() for _ in range(shard_count)]
+        self._sent_versions = [self.view.ping_cache.version] * shard_count
+        self._processes = []
+        self._reader = None
+        self._done = set()
+        self.error = None
+
+    def start(self) -> None:
+        for shard, ring in enumerate(self._rings):
+            worker = self._context.Process(target=_shard_process, name=f"shard {shard}", daemon=True,
+                                           args=(shard, ring, self._results, self._controls[shard], self._local_ip,
+                                                 self._sortmode, self._sortorder, self._cache_path,
+                                                 self._archive_path, self._archive_retention_days,
+                                                 self._server_range_files))
+            worker.start()
+            self._processes.append(worker)
+        # multiprocessing replaces stdin in child processes, so hand the reader its own copy of the fd
+        source_fd = os.dup(self._source.fileno())
+        reader = self._context.Process(target=_reader_process, name="reader", daemon=True,
+                                       args=(source_fd, self._rings, self._local_ip))
+        reader.start()
+        os.close(source_fd)
+        self._processes.append(reader)
+        self._reader = reader
+
+    def finished(self) -> bool:
+        return len(self._done) == self.shard_count
+
+    # merges any pending results into the view, waiting up to timeout seconds for the first one.
+    # returns True if the view changed.
+    def poll(self, timeout: float = 1) -> bool:
+        changed = False
+        block = True
+        while not self.finished():
+            if self._check_processes(): break
+            try:
+                message = self._results.get(block=block, timeout=timeout if block else None)
+            except queue.Empty:
+                if self._check_processes(): break
+                if block and not any(p.is_alive() for p in self._processes):
+                    # every process has gone away without saying so, don't wait forever
+                    self._done = set(range(self.shard_count))
+                break
+            block = False
+            changed = self._handle(message) or changed
+        return changed
+
+    # merges one result into the view. returns True if the view changed
+    def _handle(self, message: tuple, share: bool = True) -> bool:
+        if message[0] == "done":
+            self._done.add(message[1])
+            return False
+        _, shard, shard_peers, last_packet_time, last_maintenance_time, cache_storage = message
+        self.view.merge_shard(shard, shard_peers, last_packet_time, last_maintenance_time, cache_storage)
+        if cache_storage is not None and share:
+            self._share_cache()
+        return True
+
+    def _check_processes(self) -> bool:
+        # a process that has crashed will never finish its share of the work, so rather than wait
+        # forever we stop everything. returns True if we've stopped
+        for p in self._processes:
+            if p.exitcode is not None and p.exitcode != 0:
+                self.error = f"{p.name} process exited with code {p.exitcode}"
+                self._done = set(range(self.shard_count))
+                return True
+        return False
+
+    def _share_cache(self) -> None:
+        # sends each shard whatever the merged cache has learned since it was last sent anything
+        version = self.view.ping_cache.version
+        for shard, control in enumerate(self._controls):
+            if self._sent_versions[shard] < version:
+                control.put(self.view.ping_cache.changes_since(self._sent_versions[shard]))
+                self._sent_versions[shard] = version
+
+    def close(self, timeout: float = 10) -> None:
+        # the reader is stopped outright. the workers are told the stream has ended, as if it had
+        # run out, so they write their queued archive sessions and send their last results
+        if self._reader is not None and self._reader.is_alive():
+            self._reader.terminate()
+        for ring in self._rings:
+            ring.close_writer()
+        deadline = time.monotonic() + timeout
+        # a worker can't exit while its results are still waiting to be read, so keep reading them
+        while any(p.is_alive() for p in self._processes) and time.monotonic() < deadline:
+            try:
+                self._handle(self._results.get(timeout=0.1), share=False)
+            except queue.Empty:
+                pass
+        for p in self._processes:
+            if p.is_alive(): p.terminate()
+            p.join()
+        # cache changes a worker never read shouldn't hold up our exit
+        for control in self._controls:
+            control.cancel_join_thread()
+        for ring in self._rings:
+            ring.release(unlink=True)
@@ -0,0 +1,81 @@
+from LibPeerFrom.Peers import Peers
+from LibPeerFrom import Helpers
+from datetime import datetime, timedelta
+
+import os
+import pickle
+import tempfile
+import time
+import zlib
+
+# A snapshot is a compact binary copy of our warm state: the ping cache, recent geoip lookups and
+# the active peers. It's written on shutdown and read on start, so a restart mid-session shows
+# peers (with their pings, history and locations) straight away, without parsing the json ping
+# cache or looking anyone up again. The json cache is still the source of truth: if it has
+# changed since the snapshot was written, it's read instead of the snapshot's copy.
+SNAPSHOT_MAGIC = b"WDTPSNAP"
+SNAPSHOT_VERSION = 2
+# peers not seen for this long before the restart are finished with, as in Peers.run_maintenance
+SNAPSHOT_PEER_TIMEOUT = timedelta(seconds=30)
+
+
+def write_snapshot(fileName: str, peers: Peers) -> None:
+    data = {
+        "saved": time.time(),
+        "local_ip": peers.local_ip,
+        "ping_cache": peers.ping_cache.to_dict(),
+        "ping_cache_mtime": peers.ping_cache.backing_cache_mtime(),
+        "geoip_cache": Helpers.GEOIP_CACHE,
+        "peers": list(peers),
+    }
+    payload = zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    directory = os.path.dirname(os.path.abspath(fileName))
+    fd, temp_path = tempfile.mkstemp(prefix=".snapshot", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + payload)
+        os.replace(temp_path, fileName)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def read_snapshot(fileName: str) -> dict:
+    # None if there's no snapshot, or it's from an incompatible version
+    try:
+        with open(fileName, 'rb') as snapshot_file:
+            header = snapshot_file.read(len(SNAPSHOT_MAGIC) + 1)
+            if header != SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]):
+                print("Ignoring snapshot from another version:", fileName)
+                return None
+            return pickle.loads(zlib.decompress(snapshot_file.read()))
+    except FileNotFoundError:
+        return None
+    except (zlib.error, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        print("Couldn't read snapshot", fileName, e)
+        return None
+
+
+# returns True if the ping cache was restored, from the snapshot or (if it has changed since) the
+# cache file. otherwise there was no usable snapshot, and the caller should restore_cache
+def restore_snapshot(fileName: str, peers: Peers, timestamp: datetime = None) -> bool:
+    if timestamp is None: timestamp = datetime.now()
+    data = read_snapshot(fileName)
+    if data is None: return False
+
+    for ip, lookup in data["geoip_cache"].items():
+        Helpers.GEOIP_CACHE.setdefault(ip, lookup)
+
+    if data["ping_cache_mtime"] == peers.ping_cache.backing_cache_mtime():
+        peers.ping_cache.restore_dict(data["ping_cache"])
+    else:
+        # read the cache file now rather than leave it to the caller, as finishing stale peers
+        # below records their pings into the cache, and restoring it afterwards would lose them
+        peers.restore_cache()
+
+    if data["local_ip"] == peers.local_ip:
+        for peer in data["peers"]:
+            peers.add_peer(peer)
+        # peers that finished while we were stopped are recorded (and cached) as usual
+        peers.remove_stale_peers(timestamp - SNAPSHOT_PEER_TIMEOUT)
+    return True
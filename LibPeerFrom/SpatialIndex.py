@@ -0,0 +1,81 @@
+from math import radians, cos, sin, asin
+from heapq import heappush, heapreplace
+from typing import Any
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def to_unit_vector(latitude: float, longitude: float) -> tuple[float, float, float]:
+    # points on the unit sphere, so straight line distance orders the same as great circle
+    # distance and there's no wrap around at +/-180 longitude
+    lat = radians(latitude)
+    lon = radians(longitude)
+    return (cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat))
+
+
+def chord_to_km(chord: float) -> float:
+    return 2 * EARTH_RADIUS_KM * asin(min(chord / 2, 1))
+
+
+class KDTree:
+    # A static 3d k-d tree over (latitude, longitude) points, each with a payload.
+    # Built once in O(n log n), then each nearest neighbour query is O(log n) on average.
+    # Rebuild it when the points change.
+    _points: list[tuple[float, float, float]]
+    _payloads: list[Any]
+    _left: list[int]
+    _right: list[int]
+    _axis: list[int]
+    _root: int
+
+    def __init__(self, locations: list[tuple[float, float, Any]]):
+        self._points = []
+        self._payloads = []
+        self._left = []
+        self._right = []
+        self._axis = []
+        items = [(to_unit_vector(lat, lon), payload) for lat, lon, payload in locations]
+        self._root = self._build(items, 0)
+
+    def _build(self, items: list, depth: int) -> int:
+        if len(items) == 0: return -1
+        axis = depth % 3
+        items.sort(key=lambda item: item[0][axis])
+        median = len(items) // 2
+        node = len(self._points)
+        self._points.append(items[median][0])
+        self._payloads.append(items[median][1])
+        self._axis.append(axis)
+        self._left.append(-1)
+        self._right.append(-1)
+        self._left[node] = self._build(items[:median], depth + 1)
+        self._right[node] = self._build(items[median + 1:], depth + 1)
+        return node
+
+    def nearest(self, latitude: float, longitude: float, k: int = 1) -> list[tuple[float, Any]]:
+        # returns up to k (distance in km, payload) pairs, nearest first
+        if self._root < 0 or k < 1: return []
+        target = to_unit_vector(latitude, longitude)
+        best = []  # max heap of (-squared distance, node)
+        stack = [self._root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node < 0: continue
+            point = self._points[node]
+            distance = (point[0] - target[0]) ** 2 + (point[1] - target[1]) ** 2 + (point[2] - target[2]) ** 2
+            if len(best) < k:
+                heappush(best, (-distance, node))
+            elif distance < -best[0][0]:
+                heapreplace(best, (-distance, node))
+            axis = self._axis[node]
+            offset = target[axis] - point[axis]
+            near, far = (self._left[node], self._right[node]) if offset < 0 else (self._right[node], self._left[node])
+            # only look on the far side of the split if it could hold something closer
+            if len(best) < k or offset * offset < -best[0][0]:
+                stack.append(far)
+            stack.append(near)
+        return [(chord_to_km(d ** 0.5), self._payloads[node]) for d, node in
+                sorted((-negative, node) for negative, node in best)]
+
+    def __len__(self) -> int:
+        return len(self._points)
@@ -0,0 +1,69 @@
+from array import array
+from typing import Iterator
+
+
+class RingSeries:
+    # A fixed size ring of (timestamp, value) samples, backed by preallocated arrays.
+    # Once full, each append overwrites the oldest sample, so memory per series never grows
+    # and appending never allocates.
+    __slots__ = ("_times", "_values", "_next", "_count")
+    _times: array
+    _values: array
+    _next: int
+    _count: int
+
+    def __init__(self, capacity: int):
+        if capacity < 1: raise ValueError("Invalid capacity specified")
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._next = 0
+        self._count = 0
+
+    def append(self, timestamp: float, value: float) -> None:
+        i = self._next
+        self._times[i] = timestamp
+        self._values[i] = value
+        i += 1
+        self._next = 0 if i == len(self._values) else i
+        if self._count < len(self._values):
+            self._count += 1
+
+    @property
+    def capacity(self) -> int:
+        return len(self._values)
+
+    def latest(self) -> float:
+        if self._count == 0: return None
+        return self._values[self._next - 1]
+
+    def _order(self) -> Iterator[int]:
+        # indexes from oldest to newest
+        start = self._next - self._count
+        for i in range(start, self._next):
+            yield i % len(self._values)
+
+    def values(self) -> list[float]:
+        return [self._values[i] for i in self._order()]
+
+    def times(self) -> list[float]:
+        return [self._times[i] for i in self._order()]
+
+    def downsample(self, points: int) -> list[tuple[float, float, float]]:
+        # splits the samples into (up to) points buckets, and returns (min, mean, max) for each
+        values = self.values()
+        if len(values) == 0 or points < 1: return []
+        points = min(points, len(values))
+        buckets = []
+        for b in range(points):
+            bucket = values[b * len(values) // points:(b + 1) * len(values) // points]
+            buckets.append((min(bucket), sum(bucket) / len(bucket), max(bucket)))
+        return buckets
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getstate__(self):
+        return (self._times, self._values, self._next, self._count)
+
+    def __setstate__(self, state):
+        self._times, self._values, self._next, self._count = state
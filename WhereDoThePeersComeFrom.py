@@ -2,19 +2,20 @@
 import sys
 import signal
 import getopt
-import subprocess
+import shlex
 
 import json
 from datetime import datetime, timedelta
-import time
-
-import pyshark
-from pyshark.packet.packet import Packet
-from pyshark.capture.pipe_capture import PipeCapture
 
 import LibPeerFrom.Helpers
 from LibPeerFrom.Peer import Peer
 from LibPeerFrom.Peers import Peers
+from LibPeerFrom.ShardedIngest import ShardedIngest
+from LibPeerFrom.CaptureProfile import CaptureProfile
+from LibPeerFrom.RangeIndex import RangeIndex
+from LibPeerFrom.CaptureSource import ReconnectingCapture, ssh_command
+from LibPeerFrom.Snapshot import write_snapshot, restore_snapshot
+from LibPeerFrom.FakePinger import FakePinger
 
 def usage():
     print("WhereDoThePeersComeFrom.py: a tool to monitor latency to peers in a from software multiplayer session")
@@ -30,9 +31,37 @@ def usage():
     print("                                 default is descending")
     print(" --cachepath:                path to the ping cache file")
     print("                                 default is \"\" (no cache). will be created if none exists.")
+    print(" --snapshot_path:            path to a binary snapshot of the ping cache, geoip lookups and current peers.")
+    print("                                 written on exit and read on start, so restarts mid-session are quick.")
+    print("                                 default is \"\" (no snapshot). not used with --workers")
+    print(" --archive_path:             path to a sqlite file recording every finished peer session")
+    print("                                 default is \"\" (no archive). will be created if none exists.")
+    print(" --archive_retention_days:   drop archived sessions older than this many days.")
+    print("                                 default is 0 (keep forever)")
+    print(" --server_ranges:            comma separated paths to ip range files (e.g. aws ip-ranges.json) of relay and")
+    print("                                 matchmaking servers. these are never treated as peers. reloaded when changed.")
     print(" --router_address:           address to ssh to. if this is not supplied we assume a wireshark capture")
     print("                                 is supplied to stdin. assumes that default ssh settings will work")
+    print(" --capture_command:          run this local command instead of ssh. its stdout should be a pcap stream,")
+    print("                                 e.g. \"python3 -m LibPeerFrom.FakeCapture capture.pcap\" to test reconnecting")
+    print(" --capture_profile:          what the router captures. options are:")
+    print("                                 full: every packet to or from the address, as before")
+    print("                                 udp: only udp that could be from a peer (no reserved addresses,")
+    print("                                      known servers or dns/ntp/mdns etc)")
+    print("                                 lean: as udp, but only the start of each packet is captured")
+    print("                                 default is udp")
+    print(" --udp_ports:                only capture these udp ports, e.g. 3000-3100,5000. default is all ports")
+    print(" --snaplen:                  bytes of each packet to capture, overriding the profile. 0 is the whole packet")
+    print(" --resend_prefix_bytes:      bytes of each payload used to detect resends, overriding the profile.")
+    print("                                 0 is the whole payload. should fit in the snaplen after headers")
+    print(" --print_capture_command:    print the tcpdump command for the capture profile and exit. useful for")
+    print("                                 piping a capture in from stdin")
     print(" --ipinfo_token              token for accessing ipinfo.io. if this is not provided you may be rate limited")
+    print(" --ipinfo_url                base url for geoip lookups, e.g. a local LibPeerFrom.FakeIpinfo for testing.")
+    print("                                 default is https://ipinfo.io")
+    print(" --ipinfo_timeout            seconds to wait for a geoip lookup. default is 10")
+    print(" --ping_profiles             path to a json file of fake ping latency and loss profiles. pings are")
+    print("                                 simulated with LibPeerFrom.FakePinger rather than sent. for testing only")
     print(" --config_file               path to json-formatted config file")
     print(" --friendlyname_file         path to json-formatted map from ip to friendlyname")
     print(" --html_file                 path to a html file for outputting. should be in the same folder as main.css.")
@@ -40,6 +69,9 @@ def usage():
     print(" --peers_json_file           path to a json file for outputting peer status. will be created if it does not exist.")
     print("                                 no output if unspecified.")
     print(" --no_tui                    don't print the terminal ui")
+    print(" --workers                   number of worker processes to split peers across. values above 1 read the")
+    print("                                 capture directly (pcap only, no tshark) and spread the work over cores.")
+    print("                                 default is 1")
     print("")
 
 def clear_stdout_stderr():
@@ -53,8 +85,11 @@ signal.signal(signal.SIGINT, sigint_handler)
 try:
     opts, args = getopt.getopt(sys.argv[1:], ["vha:m:o:"], ["help", "no_tui", "config_file=", "debug", "verbose", \
                                                             "address=", "sortmode=", "sortorder=", \
-                                                            "cachepath=","router_address=", \
-                                                            "ipinfo_token=","html_file=","friendlyname_file=","peers_json_file="])
+                                                            "cachepath=","snapshot_path=","router_address=", "archive_path=", "archive_retention_days=", \
+                                                            "server_ranges=", "capture_command=", "capture_profile=", "udp_ports=", "snaplen=", \
+                                                            "resend_prefix_bytes=", "print_capture_command", \
+                                                            "ipinfo_token=","ipinfo_url=","ipinfo_timeout=","ping_profiles=","html_file=","friendlyname_file=","peers_json_file=", \
+                                                            "workers="])
 except getopt.GetoptError as e:
     print(e)
     usage()
@@ -66,12 +101,21 @@ def main():
     sort_mode = "last_seen"
     sort_order = "descending"
     cache_path = ""
+    snapshot_path = ""
+    archive_path = ""
+    archive_retention_days = 0
+    server_range_files = []
     router_address = ""
+    capture_command_override = ""
     config_file_path = ""
     friendlyname_file_path = ""
     html_file = ""
     peers_json_file = "/tmp/WhereDoThePeersComeFrom.html"
     show_tui = True
+    shard_count = 1
+    capture_profile_name = CaptureProfile.DEFAULT_PROFILE
+    capture_settings = dict()
+    print_capture_command = False
 
     for o, a in opts:
         if o in ["--help", "-h"]:
@@ -99,10 +143,41 @@ def main():
                 exit()
         elif o in ["--cachepath"]:
             cache_path = a
+        elif o in ["--snapshot_path"]:
+            snapshot_path = a
+        elif o in ["--archive_path"]:
+            archive_path = a
+        elif o in ["--archive_retention_days"]:
+            archive_retention_days = int(a)
+        elif o in ["--server_ranges"]:
+            server_range_files = [f for f in a.split(",") if f != ""]
+        elif o in ["--capture_command"]:
+            capture_command_override = a
+        elif o in ["--capture_profile"]:
+            if a.lower() in CaptureProfile.PROFILES.keys():
+                capture_profile_name = a.lower()
+            else:
+                print("bad capture profile supplied")
+                usage()
+                exit()
+        elif o in ["--udp_ports"]:
+            capture_settings["ports"] = CaptureProfile.parse_ports(a)
+        elif o in ["--snaplen"]:
+            capture_settings["snaplen"] = int(a)
+        elif o in ["--resend_prefix_bytes"]:
+            capture_settings["resend_prefix_bytes"] = int(a)
+        elif o in ["--print_capture_command"]:
+            print_capture_command = True
         elif o in ["--router_address"]:
             router_address = a
         elif o in ["--ipinfo_token"]:
             LibPeerFrom.Helpers.IPINFO_TOKEN = a
+        elif o in ["--ipinfo_url"]:
+            LibPeerFrom.Helpers.IPINFO_URL = a.rstrip("/")
+        elif o in ["--ipinfo_timeout"]:
+            LibPeerFrom.Helpers.IPINFO_TIMEOUT = float(a)
+        elif o in ["--ping_profiles"]:
+            LibPeerFrom.Helpers.PINGER = FakePinger.from_file(a)
         elif o in ["--config_file"]:
             config_file_path = a
         elif o in ["--html_file"]:
@@ -113,6 +188,15 @@ def main():
             peers_json_file = a
         elif o in ["--no_tui"]:
             show_tui = False
+        elif o in ["--workers"]:
+            try:
+                shard_count = int(a)
+            except ValueError:
+                shard_count = 0
+            if shard_count < 1:
+                print("bad worker count supplied")
+                usage()
+                exit()
 
     if config_file_path != "":
         with open(config_file_path) as config_file:
@@ -132,8 +216,36 @@ def main():
                 router_address = config["router_address"]
             if "cachepath" in config.keys():
                 cache_path = config["cachepath"]
+            if "snapshot_path" in config.keys():
+                snapshot_path = config["snapshot_path"]
+            if "archive_path" in config.keys():
+                archive_path = config["archive_path"]
+            if "archive_retention_days" in config.keys():
+                archive_retention_days = int(config["archive_retention_days"])
+            if "server_ranges" in config.keys():
+                if isinstance(config["server_ranges"], list):
+                    server_range_files = config["server_ranges"]
+                else:
+                    server_range_files = [f for f in config["server_ranges"].split(",") if f != ""]
+            if "capture_command" in config.keys():
+                capture_command_override = config["capture_command"]
+            if "capture_profile" in config.keys():
+                if config["capture_profile"] in CaptureProfile.PROFILES.keys():
+                    capture_profile_name = config["capture_profile"]
+            if "udp_ports" in config.keys():
+                capture_settings.setdefault("ports", CaptureProfile.parse_ports(str(config["udp_ports"])))
+            if "snaplen" in config.keys():
+                capture_settings.setdefault("snaplen", int(config["snaplen"]))
+            if "resend_prefix_bytes" in config.keys():
+                capture_settings.setdefault("resend_prefix_bytes", int(config["resend_prefix_bytes"]))
             if "ipinfo_token" in config.keys():
                 LibPeerFrom.Helpers.IPINFO_TOKEN = config["ipinfo_token"]
+            if "ipinfo_url" in config.keys():
+                LibPeerFrom.Helpers.IPINFO_URL = config["ipinfo_url"].rstrip("/")
+            if "ipinfo_timeout" in config.keys():
+                LibPeerFrom.Helpers.IPINFO_TIMEOUT = float(config["ipinfo_timeout"])
+            if "ping_profiles" in config.keys():
+                LibPeerFrom.Helpers.PINGER = FakePinger.from_file(config["ping_profiles"])
             if "html_file" in config.keys():
                 html_file = config["html_file"]
             if "debug" in config.keys():
@@ -144,135 +256,182 @@ def main():
                 friendlyname_file_path = config["friendlyname_file"]
             if "peers_json_file" in config.keys():
                 peers_json_file = config["peers_json_file"]
+            if "workers" in config.keys():
+                if int(config["workers"]) >= 1:
+                    shard_count = int(config["workers"])
             
     if local_ip == None:
         print("no IP supplied")
         usage()
         exit()
         
-    peers = Peers(local_ip, sort_mode, sort_order, cache_path)
+    capture_profile = CaptureProfile(capture_profile_name, **capture_settings)
+    LibPeerFrom.Helpers.RESEND_PREFIX_BYTES = capture_profile.resend_prefix_bytes
+    capture_command = capture_profile.tcpdump_command(local_ip, RangeIndex(server_range_files))
+    if print_capture_command:
+        print(capture_command)
+        exit()
+
     print("local IP address: ",local_ip)
+    print("capture profile: ", capture_profile)
     sys.stdout.flush()
-    last_maintenance_time = datetime.now()
-    last_print_time = last_maintenance_time
-    peers.restore_cache()
     
     # Assume we're using stdin
     pipecapture_source = sys.stdin
+    if shard_count > 1:
+        # the sharded reader parses pcap itself, so it needs the raw bytes
+        pipecapture_source = sys.stdin.buffer
 
-    if router_address != "":
-        ssh_command = f"/usr/sbin/tcpdump host {local_ip} -U -w - "
-        ssh_process = subprocess.Popen(["ssh", router_address, ssh_command], stdout=subprocess.PIPE)
-        time.sleep(2)
-        if ssh_process.poll() is not None:    
-            print("error: ssh session has closed")
-            print(ssh_process.stderr)
+    if router_address != "" or capture_command_override != "":
+        if capture_command_override != "":
+            command = shlex.split(capture_command_override)
+        else:
+            command = ssh_command(router_address, capture_command)
+        # if the session drops it's restarted, and the new stream carries on where the old one left off
+        capture = ReconnectingCapture(command)
+        if not capture.start():
+            print("error: capture source closed before the capture started")
             sys.stdout.flush()
             exit(1)
-        pipecapture_source = ssh_process.stdout
+        pipecapture_source = capture.stream
       
+    if shard_count > 1:
+        run_sharded(pipecapture_source, local_ip, shard_count, sort_mode, sort_order, cache_path,
+                    archive_path, archive_retention_days, server_range_files,
+                    friendlyname_file_path, html_file, peers_json_file, show_tui, DEBUG)
+        return
+
+    peers = Peers(local_ip, sort_mode, sort_order, cache_path, archive_path, archive_retention_days,
+                  server_range_files, friendlyname_file_path)
+    last_maintenance_time = datetime.now()
+    last_print_time = last_maintenance_time
+    if snapshot_path == "" or not restore_snapshot(snapshot_path, peers):
+        peers.restore_cache()
+
+    try:
+        run_capture(pipecapture_source, peers, local_ip, last_maintenance_time, last_print_time,
+                    cache_path, html_file, peers_json_file, show_tui, DEBUG)
+    finally:
+        if snapshot_path != "":
+            peers.persist_cache()
+            write_snapshot(snapshot_path, peers)
+
+def run_capture(source, peers: Peers, local_ip: str, last_maintenance_time: datetime, last_print_time: datetime,
+                cache_path: str, html_file: str, peers_json_file: str, show_tui: bool, DEBUG: bool):
+    # pyshark (and tshark behind it) is only needed in single process mode, so it's imported here
+    from pyshark.packet.packet import Packet
+    from pyshark.capture.pipe_capture import PipeCapture
+
     packet: Packet
-    for packet in PipeCapture(pipecapture_source):
+    for packet in PipeCapture(source):
         should_run_maintenance = False
         current_time = datetime.now()
         if 'ip' in packet and 'udp' in packet:
             p = peers.add_peer_from_packet(packet)
             # run maintenance as soon as we add a peer
-            # this will update the friendlynames.json file
             if p is not None: should_run_maintenance = True
             if p is not None and not show_tui:
                 print(f"{packet.sniff_time}: peer {p.get_name()} added ({p.estimate_geoip()})")
                 sys.stdout.flush()
 
-        
-        # run maintenance every 20 seconds, as long as there's peers
-        time_since_last_maint = packet.sniff_time - last_maintenance_time
-        if (time_since_last_maint).total_seconds() > 20 and len(peers) > 0:
-            should_run_maintenance = True
-        # run maintenance every 10 minutes if there's no peers
-        # in minute {0,10,20,30,40,50}
-        if ( time_since_last_maint.total_seconds() > 600) \
-            and packet.sniff_time.minute % 10 == 0:
+        if peers.maintenance_due(last_maintenance_time, packet.sniff_time):
             should_run_maintenance = True
         
         if should_run_maintenance:
             print("running maintenance")
             sys.stdout.flush()
-            # remove all peers that haven't been seen in the last 30s
-            peers.remove_stale_peers(packet.sniff_time - timedelta(seconds=30))
-            peers.ping_peers()
-            peers.ping_cache.apply_minimum_pings()
-            peers.estimate_guess_peers()
-            peers.persist_cache()
-            if friendlyname_file_path != "":
-                with open(friendlyname_file_path, 'r+') as friendlyname_file:
-                    friendlynames: dict[str,str] = {k:v for k,v in json.load(friendlyname_file).items() if v != ""}
-                    p: Peer
-                    for p in peers._storage:
-                        if p.remote_ip in friendlynames.keys():
-                            p.friendly_name = friendlynames[p.remote_ip]
-                        else:
-                            friendlynames[p.remote_ip] = ""
-                    friendlyname_file.seek(0)
-                    json.dump(friendlynames, friendlyname_file, sort_keys=True, indent=4)
-                    friendlyname_file.truncate()
+            peers.run_maintenance(packet.sniff_time)
             last_maintenance_time = current_time
 
-            # Cache all our accurate peers every 10 minutes
-            # This means that accurate peers will have more entries in the cache
-            if packet.sniff_time.minute % 10 == 0:
-                peers.cache_accurate_peers()
         if (packet.sniff_time - last_print_time).total_seconds() >= 1:
-            
-            if html_file != "":
-                with open(html_file, 'w') as html:
-                    headers = []
-                    headers.append(("local ip address", local_ip))
-                    headers.append(("last maintenance time", last_maintenance_time.time().strftime('%H:%M:%S')))
-                    headers.append(("current time", current_time.time().strftime('%H:%M:%S')))
-                    headers.append(("ping cache size", len(peers.ping_cache._storage)))
-                    headers.append(("peers", len(peers)))
-                    html.write(LibPeerFrom.Helpers.generate_html_view(headers, peers))     
-            if peers_json_file != "":
-                with open(peers_json_file, 'w') as j:
-                    json_output = dict()
-                    json_output["peers"] = peers.to_dict()
-                    json_output["statistics"] = {
-                                                "local_ip_address": local_ip,
-                                                "last_maintenance_time": last_maintenance_time.time().strftime('%H:%M:%S'),
-                                                "current_time": current_time.time().strftime('%H:%M:%S'),
-                                                "ping_cache_size": len(peers.ping_cache._storage),
-                                                "peers":len(peers)
-                                                }
-
-                    json.dump(json_output, j, indent=4)
-
+            write_output_files(html_file, peers_json_file, local_ip, peers, last_maintenance_time, current_time)
             last_print_time = packet.sniff_time
             
         if show_tui:
-            clear_stdout_stderr()
-            print(f"local ip address:       {local_ip}")
+            if current_time > packet.sniff_time:
+                scan_delay = current_time - packet.sniff_time
+            else:
+                scan_delay = packet.sniff_time - current_time 
+            print_tui(local_ip, peers, DEBUG, cache_path, last_maintenance_time, current_time, scan_delay)
 
-            if DEBUG:
-                if current_time > packet.sniff_time:
-                    scan_delay = current_time - packet.sniff_time
-                else:
-                    scan_delay = packet.sniff_time - current_time 
-                print(f"last maintenance time:  {last_maintenance_time.time().strftime('%H:%M:%S')}")
-                #print(f"last packet sniff time: {packet.sniff_time.time().strftime('%H:%M:%S')}")
-                print(f"current time:           {current_time.time().strftime('%H:%M:%S')}")
-                print(f"scan delay:             {scan_delay}")
-                print(f"ping cache location:    {cache_path}")
-                print(f"ping cache size:        {len(peers.ping_cache._storage)}")
-                #print(f"ping cache hit count:   {peers.ping_cache.hit_count}")
-            
-            print(f"peer(s):                {len(peers)}")
-            print()
+def run_sharded(source, local_ip: str, shard_count: int, sort_mode: str, sort_order: str, cache_path: str,
+                archive_path: str, archive_retention_days: int, server_range_files: list[str],
+                friendlyname_file_path: str, html_file: str, peers_json_file: str, show_tui: bool, DEBUG: bool):
+    ingest = ShardedIngest(source, local_ip, shard_count, sort_mode, sort_order, cache_path,
+                           archive_path, archive_retention_days, server_range_files, friendlyname_file_path)
+    peers = ingest.view
+    known_peers: set[str] = set()
+    ingest.start()
+    try:
+        while not ingest.finished():
+            if not ingest.poll(timeout=1): continue
+            current_time = datetime.now()
+            new_peers = peers.get_index() - known_peers
+            known_peers = set(peers.get_index())
+            if len(new_peers) > 0:
+                if not show_tui:
+                    for ip in new_peers:
+                        print(f"{peers[ip].first_seen}: peer {peers[ip].get_name()} added ({peers[ip].geoip})")
+                    sys.stdout.flush()
+            peers.update_friendly_names()
+            write_output_files(html_file, peers_json_file, local_ip, peers, peers.last_maintenance_time, current_time)
+            if show_tui:
+                scan_delay = timedelta(0)
+                if peers.last_packet_time is not None:
+                    scan_delay = abs(current_time - peers.last_packet_time)
+                print_tui(local_ip, peers, DEBUG, cache_path, peers.last_maintenance_time, current_time, scan_delay)
+    finally:
+        ingest.close()
+    if ingest.error is not None:
+        print("error:", ingest.error)
+        sys.stdout.flush()
+        exit(1)
 
-            # finally, we print
-            print(peers)
-            sys.stdout.flush()
+def write_output_files(html_file: str, peers_json_file: str, local_ip: str, peers: Peers,
+                       last_maintenance_time: datetime, current_time: datetime):
+    if html_file != "":
+        with open(html_file, 'w') as html:
+            headers = []
+            headers.append(("local ip address", local_ip))
+            headers.append(("last maintenance time", last_maintenance_time.time().strftime('%H:%M:%S')))
+            headers.append(("current time", current_time.time().strftime('%H:%M:%S')))
+            headers.append(("ping cache size", len(peers.ping_cache._storage)))
+            headers.append(("peers", len(peers)))
+            html.write(LibPeerFrom.Helpers.generate_html_view(headers, peers))     
+    if peers_json_file != "":
+        with open(peers_json_file, 'w') as j:
+            json_output = dict()
+            json_output["peers"] = peers.to_dict()
+            json_output["statistics"] = {
+                                        "local_ip_address": local_ip,
+                                        "last_maintenance_time": last_maintenance_time.time().strftime('%H:%M:%S'),
+                                        "current_time": current_time.time().strftime('%H:%M:%S'),
+                                        "ping_cache_size": len(peers.ping_cache._storage),
+                                        "peers":len(peers)
+                                        }
+
+            json.dump(json_output, j, indent=4)
+
+def print_tui(local_ip: str, peers: Peers, DEBUG: bool, cache_path: str, last_maintenance_time: datetime,
+              current_time: datetime, scan_delay: timedelta):
+    clear_stdout_stderr()
+    print(f"local ip address:       {local_ip}")
+
+    if DEBUG:
+        print(f"last maintenance time:  {last_maintenance_time.time().strftime('%H:%M:%S')}")
+        #print(f"last packet sniff time: {packet.sniff_time.time().strftime('%H:%M:%S')}")
+        print(f"current time:           {current_time.time().strftime('%H:%M:%S')}")
+        print(f"scan delay:             {scan_delay}")
+        print(f"ping cache location:    {cache_path}")
+        print(f"ping cache size:        {len(peers.ping_cache._storage)}")
+        #print(f"ping cache hit count:   {peers.ping_cache.hit_count}")
     
+    print(f"peer(s):                {len(peers)}")
+    print()
+
+    # finally, we print
+    print(peers)
+    sys.stdout.flush()
 
 
 if __name__ == "__main__": 